@@ -0,0 +1,38 @@
+import argparse
+import os
+
+from clip_inference import load_state_dict_file, safetensors_path, weights_fingerprint
+
+def convert_weights(model_path, output_path=None):
+    """Write the fine-tuned weights as safetensors, tagged with the fingerprint of the source .pth"""
+    from safetensors.torch import save_file
+
+    output_path = output_path or safetensors_path(model_path)
+    state_dict = load_state_dict_file(model_path)
+    # Tied or sliced tensors must own their storage to be saved
+    state_dict = {name: tensor.contiguous().clone() for name, tensor in state_dict.items()}
+    metadata = {key: str(value) for key, value in weights_fingerprint(model_path).items()}
+    save_file(state_dict, output_path, metadata=metadata)
+    print(f"Saved {len(state_dict)} tensors to {output_path}")
+    return output_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the fine-tuned CLIP weights to safetensors for fast loading")
+    parser.add_argument("--model", default="best_surgical_tool_clip.pth")
+    parser.add_argument("--output", default=None, help="safetensors path (default: next to the weights)")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print(f"Error: Model file {args.model} not found. Please run the training script first.")
+        return
+
+    try:
+        import safetensors  # noqa: F401
+    except ImportError:
+        print("❌ safetensors is not installed. Install with: pip install safetensors")
+        return
+
+    convert_weights(args.model, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from clip_inference import load_trained_model, load_text_features, model_fingerprint, list_tool_images
+
+def onnx_model_path(model_path):
+    """Path of the ONNX export stored next to the PyTorch weights"""
+    return os.path.splitext(model_path)[0] + ".onnx"
+
+def onnx_metadata_path(onnx_path):
+    """Sidecar file describing which weights and classes an ONNX export was built from"""
+    return onnx_path + ".json"
+
+class CLIPImageClassifier(torch.nn.Module):
+    """CLIP image tower with the normalized class-text matrix baked in as a constant"""
+    def __init__(self, visual, text_features):
+        super().__init__()
+        self.visual = visual
+        self.register_buffer('text_features_t', text_features.T.contiguous().float())
+
+    def forward(self, pixel_values):
+        image_features = self.visual(pixel_values)
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        logits = 100.0 * image_features @ self.text_features_t
+        return image_features, logits
+
+def export_onnx(model_path, metadata_path, onnx_path=None, opset=17):
+    """Export the fine-tuned image tower plus class-text matrix to ONNX"""
+    onnx_path = onnx_path or onnx_model_path(model_path)
+    model, preprocess, tokenizer, metadata = load_trained_model(model_path, metadata_path, "cpu")
+    class_names = metadata['class_names']
+    text_features = load_text_features(model, tokenizer, class_names, "cpu", model_path)
+
+    classifier = CLIPImageClassifier(model.visual, text_features).eval()
+    image_size = model.visual.image_size
+    if isinstance(image_size, int):
+        image_size = (image_size, image_size)
+    dummy = torch.randn(1, 3, *image_size)
+
+    print(f"Exporting image tower to {onnx_path}...")
+    torch.onnx.export(
+        classifier, dummy, onnx_path,
+        input_names=['pixel_values'],
+        output_names=['image_features', 'logits'],
+        dynamic_axes={
+            'pixel_values': {0: 'batch'},
+            'image_features': {0: 'batch'},
+            'logits': {0: 'batch'}
+        },
+        opset_version=opset
+    )
+
+    with open(onnx_metadata_path(onnx_path), 'w') as f:
+        json.dump({'fingerprint': model_fingerprint(model_path, class_names), 'opset': opset}, f, indent=2)
+
+    print(f"Saved ONNX model and metadata for {len(class_names)} classes")
+    return onnx_path
+
+def check_parity(model_path, metadata_path, image_dir, onnx_path=None, batch_size=32):
+    """Compare top-1 predictions of the PyTorch model and the ONNX export on a folder of tool images"""
+    import onnxruntime as ort
+
+    onnx_path = onnx_path or onnx_model_path(model_path)
+    model, preprocess, tokenizer, metadata = load_trained_model(model_path, metadata_path, "cpu")
+    class_names = metadata['class_names']
+    text_features = load_text_features(model, tokenizer, class_names, "cpu", model_path)
+    session = ort.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+
+    samples = list_tool_images(image_dir)
+    if not samples:
+        print(f"No images found in {image_dir}")
+        return None
+
+    agree = 0
+    torch_correct = 0
+    onnx_correct = 0
+    torch_time = 0.0
+    onnx_time = 0.0
+
+    for start in range(0, len(samples), batch_size):
+        chunk = samples[start:start + batch_size]
+        batch = torch.stack([preprocess(Image.open(path).convert('RGB')) for path, _ in chunk])
+        labels = [class_names.index(label) if label in class_names else -1 for _, label in chunk]
+
+        begin = time.perf_counter()
+        with torch.no_grad():
+            image_features = model.encode_image(batch)
+            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+            torch_pred = (image_features @ text_features.T).argmax(dim=-1).numpy()
+        torch_time += time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        logits = session.run(['logits'], {'pixel_values': batch.numpy()})[0]
+        onnx_pred = np.argmax(logits, axis=-1)
+        onnx_time += time.perf_counter() - begin
+
+        agree += int((torch_pred == onnx_pred).sum())
+        torch_correct += sum(int(p == l) for p, l in zip(torch_pred, labels))
+        onnx_correct += sum(int(p == l) for p, l in zip(onnx_pred, labels))
+
+    total = len(samples)
+    report = {
+        'images': total,
+        'top1_agreement': agree / total,
+        'torch_accuracy': torch_correct / total,
+        'onnx_accuracy': onnx_correct / total,
+        'torch_ms_per_image': 1000 * torch_time / total,
+        'onnx_ms_per_image': 1000 * onnx_time / total
+    }
+    print(f"Top-1 agreement: {report['top1_agreement']:.2%} over {total} images")
+    print(f"Accuracy: torch {report['torch_accuracy']:.2%}, onnx {report['onnx_accuracy']:.2%}")
+    print(f"Latency: torch {report['torch_ms_per_image']:.1f} ms/image, onnx {report['onnx_ms_per_image']:.1f} ms/image")
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the fine-tuned CLIP image tower to ONNX")
+    parser.add_argument("--model", default="best_surgical_tool_clip.pth")
+    parser.add_argument("--metadata", default="surgical_tool_metadata.pkl")
+    parser.add_argument("--output", default=None, help="ONNX path (default: next to the weights)")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--check", action="store_true", help="Run a top-1 parity check after exporting")
+    parser.add_argument("--images", default="tool_images", help="Image folder used by --check")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print(f"Error: Model file {args.model} not found. Please run the training script first.")
+        return
+
+    if not os.path.exists(args.metadata):
+        print(f"Error: Metadata file {args.metadata} not found. Please run the training script first.")
+        return
+
+    onnx_path = export_onnx(args.model, args.metadata, args.output, args.opset)
+    if args.check:
+        check_parity(args.model, args.metadata, args.images, onnx_path)
+
+if __name__ == "__main__":
+    main()
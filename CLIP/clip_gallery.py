@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import threading
+import uuid
+
+import numpy as np
+import torch
+from PIL import Image
+
+from clip_inference import load_trained_model, weights_fingerprint, list_tool_images
+
+class GalleryIndex:
+    """Float16 embeddings of the labelled reference photos in tool_images, memory-mapped from disk.
+
+    Every refresh writes a new matrix file and then atomically replaces the
+    manifest naming it, so the manifest is the single commit point.
+    """
+
+    MATRIX_FILE = "gallery_embeddings.f16"  # default matrix name for manifests that do not name one
+    MANIFEST_FILE = "gallery_manifest.json"
+
+    def __init__(self, image_dir, index_dir, fingerprint):
+        self.image_dir = image_dir
+        self.index_dir = index_dir
+        self.fingerprint = fingerprint
+        self.matrix_path = os.path.join(index_dir, self.MATRIX_FILE)
+        self.manifest_path = os.path.join(index_dir, self.MANIFEST_FILE)
+
+        self.entries = []
+        self.dim = None
+        self.embeddings = None
+        self.class_names = []
+        self.labels = np.zeros(0, dtype=np.int64)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _load_manifest(self):
+        """Return (entries, dim, matrix path) from disk, or an empty index if missing, torn or built with other weights"""
+        if not os.path.exists(self.manifest_path):
+            return [], None, None
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not read gallery manifest: {e}")
+            return [], None, None
+        if manifest.get('fingerprint') != self.fingerprint:
+            print("Gallery index was built with other weights, re-embedding all images")
+            return [], None, None
+        matrix_path = os.path.join(self.index_dir, manifest.get('matrix', self.MATRIX_FILE))
+        expected_bytes = len(manifest['entries']) * (manifest['dim'] or 0) * np.dtype(np.float16).itemsize
+        if not os.path.exists(matrix_path) or os.path.getsize(matrix_path) != expected_bytes:
+            print("Gallery matrix does not match its manifest, re-embedding all images")
+            return [], None, None
+        return manifest['entries'], manifest['dim'], matrix_path
+
+    def _write_manifest(self, entries, dim, matrix_path):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'fingerprint': self.fingerprint, 'dim': dim, 'entries': entries,
+                       'matrix': os.path.basename(matrix_path)}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _remove_stale_matrices(self):
+        """Delete matrix files left by earlier or interrupted refreshes"""
+        for name in os.listdir(self.index_dir):
+            path = os.path.join(self.index_dir, name)
+            if name.startswith("gallery_embeddings") and name.endswith(".f16") and path != self.matrix_path:
+                os.remove(path)
+
+    def _open(self, entries, dim):
+        """Memory-map the matrix and rebuild the class/label arrays"""
+        self.entries = entries
+        self.dim = dim
+        if entries:
+            self.embeddings = np.memmap(self.matrix_path, dtype=np.float16, mode='r', shape=(len(entries), dim))
+        else:
+            self.embeddings = np.zeros((0, dim or 0), dtype=np.float16)
+        self.class_names = sorted({entry['class_name'] for entry in entries})
+        class_to_idx = {name: i for i, name in enumerate(self.class_names)}
+        self.labels = np.array([class_to_idx[entry['class_name']] for entry in entries], dtype=np.int64)
+
+    def refresh(self, encode_fn, batch_size=64):
+        """Embed images added since the last build and drop removed ones.
+
+        Returns {'added': newly embedded images, 'removed': rows dropped}; an
+        edited image counts as both.
+        """
+        with self._lock:
+            return self._refresh(encode_fn, batch_size)
+
+    def _refresh(self, encode_fn, batch_size):
+        os.makedirs(self.index_dir, exist_ok=True)
+        old_entries, dim, old_matrix_path = self._load_manifest()
+
+        # Current state of the gallery folders
+        current = {}
+        for path, class_name in list_tool_images(self.image_dir):
+            stat = os.stat(path)
+            rel_path = os.path.relpath(path, self.image_dir)
+            current[rel_path] = {
+                'path': rel_path, 'class_name': class_name,
+                'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns
+            }
+
+        kept_rows = [row for row, entry in enumerate(old_entries) if current.get(entry['path']) == entry]
+        kept_paths = {old_entries[row]['path'] for row in kept_rows}
+        new_entries = [entry for rel_path, entry in current.items() if rel_path not in kept_paths]
+
+        if not new_entries and len(kept_rows) == len(old_entries):
+            self.matrix_path = old_matrix_path or self.matrix_path
+            self._open(old_entries, dim)
+            return {'added': 0, 'removed': 0}
+
+        # Embed only the images that are not in the index yet
+        new_embeddings = []
+        for start in range(0, len(new_entries), batch_size):
+            chunk = new_entries[start:start + batch_size]
+            features = encode_fn([os.path.join(self.image_dir, entry['path']) for entry in chunk])
+            new_embeddings.append(np.asarray(features, dtype=np.float16))
+        if new_embeddings:
+            new_embeddings = np.concatenate(new_embeddings)
+            dim = new_embeddings.shape[1]
+        else:
+            new_embeddings = np.zeros((0, dim), dtype=np.float16)
+
+        # Write the kept rows plus the new ones to a fresh file; it only takes
+        # effect once the manifest naming it has been replaced
+        if old_entries:
+            old_matrix = np.memmap(old_matrix_path, dtype=np.float16, mode='r', shape=(len(old_entries), dim))
+            kept = np.asarray(old_matrix[kept_rows])
+            del old_matrix
+        else:
+            kept = np.zeros((0, dim), dtype=np.float16)
+        matrix_path = os.path.join(self.index_dir, f"gallery_embeddings_{uuid.uuid4().hex[:12]}.f16")
+        with open(matrix_path, 'wb') as f:
+            f.write(kept.tobytes())
+            f.write(new_embeddings.tobytes())
+        entries = [old_entries[row] for row in kept_rows] + new_entries
+
+        self._write_manifest(entries, dim, matrix_path)
+        self.matrix_path = matrix_path
+        self._open(entries, dim)
+        self._remove_stale_matrices()
+        print(f"Gallery index: {len(new_entries)} images embedded, {len(entries)} total across {len(self.class_names)} classes")
+        return {'added': len(new_entries), 'removed': len(old_entries) - len(kept_rows)}
+
+def gallery_scores(image_features, gallery_features, gallery_labels, num_classes, top_k=5):
+    """Per-class scores from a similarity-weighted vote over the top-k nearest gallery images"""
+    similarity = image_features @ gallery_features.T
+    top_k = min(top_k, gallery_features.shape[0])
+    values, indices = similarity.topk(top_k, dim=-1)
+    weights = torch.softmax(100.0 * values, dim=-1)
+    scores = torch.zeros(image_features.shape[0], num_classes, device=image_features.device, dtype=weights.dtype)
+    return scores.scatter_add_(1, gallery_labels[indices], weights)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update the reference-gallery embedding index")
+    parser.add_argument("--model", default="best_surgical_tool_clip.pth")
+    parser.add_argument("--metadata", default="surgical_tool_metadata.pkl")
+    parser.add_argument("--images", default="tool_images")
+    parser.add_argument("--index-dir", default="gallery_index")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print(f"Error: Model file {args.model} not found. Please run the training script first.")
+        return
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, preprocess, tokenizer, metadata = load_trained_model(args.model, args.metadata, device)
+
+    def encode(paths):
+        batch = torch.stack([preprocess(Image.open(path).convert('RGB')) for path in paths]).to(device)
+        with torch.no_grad():
+            features = model.encode_image(batch)
+            features = features / features.norm(dim=-1, keepdim=True)
+        return features.cpu().numpy()
+
+    fingerprint = {'encoder': 'torch-none', **weights_fingerprint(args.model)}
+    index = GalleryIndex(args.images, args.index_dir, fingerprint)
+    changes = index.refresh(encode)
+    print(f"Index up to date: {len(index)} images, {changes['added']} newly embedded, {changes['removed']} removed")
+
+if __name__ == "__main__":
+    main()
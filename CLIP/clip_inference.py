@@ -4,14 +4,69 @@ from PIL import Image
 import pickle
 import os
 
+# Prompt template used for every class name, both in training and inference
+PROMPT_TEMPLATE = "a photo of a {}"
+
+def safetensors_path(model_path):
+    """Path of the safetensors copy of the weights written by clip_convert_weights.py"""
+    return os.path.splitext(model_path)[0] + ".safetensors"
+
+def load_state_dict_file(model_path):
+    """Load a checkpoint on the CPU without copying it into memory up front.
+
+    Uses a matching .safetensors copy when present (lazily memory-mapped),
+    otherwise memory-maps the .pth zip archive with torch.load(mmap=True).
+    """
+    converted = safetensors_path(model_path)
+    if converted != model_path and os.path.exists(converted):
+        try:
+            from safetensors import safe_open
+            with safe_open(converted, framework="pt") as f:
+                # Only use a copy converted from exactly these weights
+                if f.metadata() == {k: str(v) for k, v in weights_fingerprint(model_path).items()}:
+                    return {name: f.get_tensor(name) for name in f.keys()}
+                print(f"❌ {converted} was converted from other weights, ignoring it")
+        except ImportError:
+            print("❌ safetensors is not installed, loading the .pth checkpoint")
+    try:
+        return torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
+    except RuntimeError:
+        # Legacy (non-zip) checkpoints cannot be memory-mapped
+        return torch.load(model_path, map_location="cpu", weights_only=True)
+
+def _materialize_meta_buffers(model):
+    """Rebuild the non-persistent text causal masks that load_state_dict(assign=True) leaves on meta"""
+    for module in model.modules():
+        for name, buffer in list(module.named_buffers(recurse=False)):
+            if not buffer.is_meta:
+                continue
+            if name != 'attn_mask' or buffer.dim() != 2:
+                raise RuntimeError(f"Cannot rebuild meta buffer {name} of {type(module).__name__}")
+            # Same additive mask open_clip builds: -inf above the diagonal
+            mask = torch.full(tuple(buffer.shape), float("-inf"), dtype=buffer.dtype).triu_(1)
+            module.register_buffer(name, mask, persistent=False)
+    leftover = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers()) if tensor.is_meta]
+    if leftover:
+        raise RuntimeError(f"Weights missing for {leftover[:5]}")
+
 def load_trained_model(model_path, metadata_path, device):
     """Load the trained CLIP model and metadata"""
-    # Load CLIP model
-    model, _, preprocess = open_clip.create_model_and_transforms("ViT-B-32", pretrained="openai", device=device)
+    # The fine-tuned checkpoint holds every weight, so no pretrained weights are
+    # downloaded or materialized: the bare architecture is built on the meta
+    # device and the memory-mapped tensors are assigned into it directly
+    state_dict = load_state_dict_file(model_path)
+    try:
+        with torch.device("meta"):
+            model, _, preprocess = open_clip.create_model_and_transforms("ViT-B-32", pretrained=None, device="meta")
+        model.load_state_dict(state_dict, assign=True)
+        _materialize_meta_buffers(model)
+    except Exception as e:
+        # Older torch or open_clip versions: build on the CPU with random init and copy the weights in
+        print(f"Meta-device loading unavailable ({e}), building the model on the CPU")
+        model, _, preprocess = open_clip.create_model_and_transforms("ViT-B-32", pretrained=None)
+        model.load_state_dict(state_dict)
+    model = model.to(device)
     tokenizer = open_clip.get_tokenizer("ViT-B-32")
-    
-    # Load trained weights
-    model.load_state_dict(torch.load(model_path, map_location=device))
     model.eval()
     
     # Load metadata
@@ -20,12 +75,89 @@ def load_trained_model(model_path, metadata_path, device):
     
     return model, preprocess, tokenizer, metadata
 
-def classify_image(image_path, model, preprocess, metadata, device, tokenizer=None):
+def text_features_cache_path(model_path):
+    """Path of the cached class-prompt embeddings stored next to the model weights"""
+    return os.path.splitext(model_path)[0] + "_text_features.pt"
+
+def weights_fingerprint(model_path):
+    """Identify a weights file cheaply by size and modification time"""
+    stat = os.stat(model_path)
+    return {
+        'weights_size': stat.st_size,
+        'weights_mtime_ns': stat.st_mtime_ns
+    }
+
+def model_fingerprint(model_path, class_names):
+    """Identify the weights and class list that derived artifacts (text features, exports) were built from"""
+    return {
+        'class_names': list(class_names),
+        'prompt_template': PROMPT_TEMPLATE,
+        **weights_fingerprint(model_path)
+    }
+
+def compute_text_features(model, tokenizer, class_names, device):
+    """Encode the class prompts and return the L2-normalized text-feature matrix"""
+    text_inputs = [PROMPT_TEMPLATE.format(class_name) for class_name in class_names]
+    with torch.no_grad():
+        text_tokens = tokenizer(text_inputs).to(device)
+        text_features = model.encode_text(text_tokens)
+        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+    return text_features
+
+def load_text_features(model, tokenizer, class_names, device, model_path=None):
+    """Load the normalized text-feature matrix from disk, rebuilding it if the class list or weights changed"""
+    if model_path is None or not os.path.exists(model_path):
+        return compute_text_features(model, tokenizer, class_names, device)
+    
+    cache_path = text_features_cache_path(model_path)
+    fingerprint = model_fingerprint(model_path, class_names)
+    
+    if os.path.exists(cache_path):
+        try:
+            cached = torch.load(cache_path, map_location=device)
+            if cached.get('fingerprint') == fingerprint:
+                return cached['text_features'].to(device)
+            print("Cached text features are stale, recomputing...")
+        except Exception as e:
+            print(f"Could not read cached text features from {cache_path}: {e}")
+    
+    text_features = compute_text_features(model, tokenizer, class_names, device)
+    try:
+        torch.save({'fingerprint': fingerprint, 'text_features': text_features.cpu()}, cache_path)
+    except OSError as e:
+        print(f"Could not save text features to {cache_path}: {e}")
+    return text_features
+
+def quantization_report_path(model_path):
+    """Path of the INT8 evaluation report written by clip_quantize.py"""
+    return os.path.splitext(model_path)[0] + "_int8.json"
+
+def quantize_image_tower(model):
+    """Apply dynamic INT8 quantization to the Linear layers of the image tower (CPU only)"""
+    model.visual = torch.ao.quantization.quantize_dynamic(model.visual, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+def list_tool_images(root_dir):
+    """List (image_path, class_name) pairs from a tool_images style folder tree"""
+    samples = []
+    for tool_folder in sorted(os.listdir(root_dir)):
+        tool_path = os.path.join(root_dir, tool_folder)
+        if os.path.isdir(tool_path) and not tool_folder.startswith('.'):
+            for image_file in sorted(os.listdir(tool_path)):
+                if image_file.lower().endswith(('.png', '.jpg', '.jpeg')):
+                    samples.append((os.path.join(tool_path, image_file), tool_folder))
+    return samples
+
+def classify_image(image_path, model, preprocess, metadata, device, tokenizer=None, text_features=None):
     """Classify a single image"""
-    # Create tokenizer if not provided
-    if tokenizer is None:
-        import open_clip
-        tokenizer = open_clip.get_tokenizer("ViT-B-32")
+    class_names = metadata['class_names']
+    
+    # Build the class text features only when the caller has not cached them
+    if text_features is None:
+        if tokenizer is None:
+            import open_clip
+            tokenizer = open_clip.get_tokenizer("ViT-B-32")
+        text_features = compute_text_features(model, tokenizer, class_names, device)
     
     # Load and preprocess image
     image = Image.open(image_path).convert('RGB')
@@ -34,16 +166,7 @@ def classify_image(image_path, model, preprocess, metadata, device, tokenizer=No
     # Get image features
     with torch.no_grad():
         image_features = model.encode_image(image_input)
-        
-        # Create text features for all classes
-        class_names = metadata['class_names']
-        text_inputs = [f"a photo of a {class_name}" for class_name in class_names]
-        text_tokens = tokenizer(text_inputs).to(device)
-        text_features = model.encode_text(text_tokens)
-        
-        # Normalize features
         image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
         
         # Calculate similarity
         similarity = 100.0 * image_features @ text_features.T
@@ -89,7 +212,8 @@ def main():
     
     if os.path.exists(test_image_path):
         print(f"\nClassifying image: {test_image_path}")
-        result = classify_image(test_image_path, model, preprocess, metadata, device)
+        text_features = load_text_features(model, tokenizer, metadata['class_names'], device, model_path)
+        result = classify_image(test_image_path, model, preprocess, metadata, device, text_features=text_features)
         
         print(f"Predicted class: {result['predicted_class']}")
         print(f"Confidence: {result['confidence']:.2%}")
@@ -0,0 +1,114 @@
+import argparse
+import copy
+import json
+import os
+import time
+
+import torch
+from PIL import Image
+from sklearn.model_selection import train_test_split
+
+from clip_inference import (
+    load_trained_model, load_text_features, model_fingerprint,
+    quantization_report_path, quantize_image_tower
+)
+from clip_training import load_dataset_from_folder
+
+def validation_split(image_dir):
+    """Recreate the 20% stratified validation split used by clip_training.py as (path, class_name) pairs"""
+    image_paths, labels, label_to_idx = load_dataset_from_folder(image_dir)
+    idx_to_label = {v: k for k, v in label_to_idx.items()}
+    _, val_paths, _, val_labels = train_test_split(
+        image_paths, labels, test_size=0.2, random_state=42, stratify=labels
+    )
+    return [(path, idx_to_label[label]) for path, label in zip(val_paths, val_labels)]
+
+def evaluate(model, preprocess, text_features, class_names, samples, batch_size=32):
+    """Return top-1 accuracy, per-image latency in ms, and predictions for a list of (path, label) samples"""
+    correct = 0
+    elapsed = 0.0
+    predictions = []
+    for start in range(0, len(samples), batch_size):
+        chunk = samples[start:start + batch_size]
+        batch = torch.stack([preprocess(Image.open(path).convert('RGB')) for path, _ in chunk])
+
+        begin = time.perf_counter()
+        with torch.no_grad():
+            image_features = model.encode_image(batch)
+            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+            predicted = (image_features @ text_features.T).argmax(dim=-1).tolist()
+        elapsed += time.perf_counter() - begin
+
+        for idx, (_, label) in zip(predicted, chunk):
+            correct += int(class_names[idx] == label)
+            predictions.append(idx)
+    return correct / len(samples), 1000 * elapsed / len(samples), predictions
+
+def evaluate_quantization(model_path, metadata_path, image_dir, max_accuracy_drop=0.01, batch_size=32):
+    """Compare the FP32 and dynamic INT8 image towers and write the activation gate report"""
+    torch.set_grad_enabled(False)
+    model, preprocess, tokenizer, metadata = load_trained_model(model_path, metadata_path, "cpu")
+    class_names = metadata['class_names']
+    text_features = load_text_features(model, tokenizer, class_names, "cpu", model_path)
+
+    samples = validation_split(image_dir)
+    print(f"Evaluating on {len(samples)} validation images...")
+
+    fp32_accuracy, fp32_ms, fp32_pred = evaluate(model, preprocess, text_features, class_names, samples, batch_size)
+    print(f"FP32: accuracy {fp32_accuracy:.2%}, {fp32_ms:.1f} ms/image")
+
+    int8_model = quantize_image_tower(copy.deepcopy(model))
+    int8_accuracy, int8_ms, int8_pred = evaluate(int8_model, preprocess, text_features, class_names, samples, batch_size)
+    print(f"INT8: accuracy {int8_accuracy:.2%}, {int8_ms:.1f} ms/image")
+
+    accuracy_delta = int8_accuracy - fp32_accuracy
+    accepted = -accuracy_delta <= max_accuracy_drop
+    report = {
+        'fingerprint': model_fingerprint(model_path, class_names),
+        'mode': 'int8-dynamic',
+        'validation_images': len(samples),
+        'fp32_accuracy': fp32_accuracy,
+        'int8_accuracy': int8_accuracy,
+        'accuracy_delta': accuracy_delta,
+        'max_accuracy_drop': max_accuracy_drop,
+        'top1_agreement': sum(int(a == b) for a, b in zip(fp32_pred, int8_pred)) / len(samples),
+        'fp32_ms_per_image': fp32_ms,
+        'int8_ms_per_image': int8_ms,
+        'speedup': fp32_ms / int8_ms if int8_ms > 0 else 0.0,
+        'accepted': accepted
+    }
+
+    report_path = quantization_report_path(model_path)
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"Accuracy delta: {accuracy_delta:+.2%} (allowed drop {max_accuracy_drop:.2%})")
+    print(f"Speedup: {report['speedup']:.2f}x")
+    if accepted:
+        print(f"✅ INT8 model accepted, report saved to {report_path}")
+    else:
+        print(f"❌ INT8 model rejected, CLIPService will keep using FP32 (report saved to {report_path})")
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate dynamic INT8 quantization of the CLIP image tower")
+    parser.add_argument("--model", default="best_surgical_tool_clip.pth")
+    parser.add_argument("--metadata", default="surgical_tool_metadata.pkl")
+    parser.add_argument("--images", default="tool_images")
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.01,
+                        help="Largest allowed top-1 accuracy drop (fraction) before INT8 is refused")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print(f"Error: Model file {args.model} not found. Please run the training script first.")
+        return
+
+    if not os.path.exists(args.metadata):
+        print(f"Error: Metadata file {args.metadata} not found. Please run the training script first.")
+        return
+
+    evaluate_quantization(args.model, args.metadata, args.images, args.max_accuracy_drop, args.batch_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from profiling import sampled_thread
+
+class ExecutorSaturated(Exception):
+    """Raised when the ML executor already holds its maximum number of jobs"""
+
+def _call_sampled(fn):
+    # Runs inside the caller's copied context so a profiled request also samples this worker
+    with sampled_thread():
+        return fn()
+
+class BoundedExecutor:
+    """Dedicated thread pool for blocking ML work with a cap on running plus queued jobs"""
+    def __init__(self, max_workers: int = 4, max_queue: int = 16):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ml-worker")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.rejected = 0
+
+    def _release(self, _future):
+        with self._lock:
+            self._pending -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        """Run fn in the pool without blocking the event loop; raise ExecutorSaturated when full"""
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise ExecutorSaturated()
+            self._pending += 1
+        try:
+            context = contextvars.copy_context()
+            future = self._executor.submit(context.run, _call_sampled, functools.partial(fn, *args, **kwargs))
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        # Release the slot when the job finishes, even if the client went away
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def running(self) -> int:
+        """Jobs currently executing on a worker thread"""
+        with self._lock:
+            return min(self._pending, self.max_workers)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = self._pending
+        return {
+            'workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'in_flight': pending,
+            'queued': max(0, pending - self.max_workers),
+            'rejected': self.rejected
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,139 @@
+import itertools
+import threading
+from collections import deque
+
+from tool_matching import get_matcher, normalize_tool_name
+
+class RunningInventory:
+    """Cumulative tool inventory of one session, updated from count deltas.
+
+    Each source (uploads, the realtime camera, ...) contributes its own counts;
+    the inventory is their sum. Only the tools whose count changed are re-matched
+    against the required list, and every visible change gets a sequence number so
+    clients can poll for what changed since their last one.
+    """
+    def __init__(self, required_tools: list, max_changes: int = 512):
+        self.matcher = get_matcher(required_tools)
+        self.total_required = len(required_tools)
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.counts = {}  # normalized tool -> total count over all sources
+        self.sources = {}  # source -> {normalized tool: count}
+        # Required key -> detected tools currently satisfying it, in the order they appeared
+        self.present = {norm_req: {} for norm_req in self.matcher.required}
+        self.matched = 0
+        self.extra = set()
+        self._requirements = {}
+        self.changes = deque(maxlen=max_changes)
+
+    def _requirements_for(self, norm_det: str) -> list:
+        """Required keys a detected name satisfies (exact, alias or partial), cached per name"""
+        requirements = self._requirements.get(norm_det)
+        if requirements is None:
+            requirements = list(dict.fromkeys(self.matcher.exact.get(norm_det, []) + self.matcher.related(norm_det)))
+            self._requirements[norm_det] = requirements
+        return requirements
+
+    def _required_count(self, norm_req: str) -> int:
+        present = self.present[norm_req]
+        if norm_req in present:
+            return self.counts[norm_req]
+        return self.counts[next(iter(present))] if present else 0
+
+    def _record(self, change: dict):
+        self.seq += 1
+        self.changes.append({'seq': self.seq, **change})
+
+    def _set_count(self, norm_det: str, count: int):
+        old = self.counts.get(norm_det, 0)
+        if count == old:
+            return
+        if count > 0:
+            self.counts[norm_det] = count
+        else:
+            del self.counts[norm_det]
+        self._record({'type': 'tool', 'tool': norm_det, 'count': count})
+
+        requirements = self._requirements_for(norm_det)
+        if not requirements:
+            if count > 0:
+                self.extra.add(norm_det)
+            else:
+                self.extra.discard(norm_det)
+            return
+        for norm_req in requirements:
+            present = self.present[norm_req]
+            if count > 0 and old == 0:
+                present[norm_det] = None
+                if len(present) == 1:
+                    self.matched += 1
+            elif count == 0:
+                del present[norm_det]
+                if not present:
+                    self.matched -= 1
+            self._record({
+                'type': 'required',
+                'tool': self.matcher.required[norm_req],
+                'status': 'matched' if present else 'missing',
+                'count': self._required_count(norm_req)
+            })
+
+    def add(self, source: str, tool_counts: dict) -> int:
+        """Add counts to a source (e.g. one more uploaded image); returns the new sequence number"""
+        with self.lock:
+            counts = self.sources.setdefault(source, {})
+            for tool, count in tool_counts.items():
+                norm_det = normalize_tool_name(tool)
+                counts[norm_det] = counts.get(norm_det, 0) + count
+                self._set_count(norm_det, self.counts.get(norm_det, 0) + count)
+            return self.seq
+
+    def replace(self, source: str, tool_counts: dict) -> int:
+        """Replace a source's counts (e.g. the tools visible in the latest frame); only differences are applied"""
+        with self.lock:
+            new = {}
+            for tool, count in tool_counts.items():
+                norm_det = normalize_tool_name(tool)
+                new[norm_det] = new.get(norm_det, 0) + count
+            old = self.sources.get(source, {})
+            for norm_det in old.keys() | new.keys():
+                delta = new.get(norm_det, 0) - old.get(norm_det, 0)
+                if delta:
+                    self._set_count(norm_det, self.counts.get(norm_det, 0) + delta)
+            self.sources[source] = new
+            return self.seq
+
+    def _completion(self) -> float:
+        return round(self.matched / self.total_required * 100, 1) if self.total_required else 0
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            matched = {}
+            missing = []
+            for norm_req, orig_req in self.matcher.required.items():
+                if self.present[norm_req]:
+                    matched[orig_req] = self._required_count(norm_req)
+                else:
+                    missing.append(orig_req)
+            return {
+                'seq': self.seq,
+                'detected': dict(self.counts),
+                'matched': matched,
+                'missing': missing,
+                'extra': {tool: self.counts[tool] for tool in self.extra},
+                'completion_percentage': self._completion()
+            }
+
+    def changes_since(self, seq: int) -> dict:
+        """Changes after seq, or a full snapshot if they are no longer retained"""
+        with self.lock:
+            oldest = self.changes[0]['seq'] if self.changes else self.seq + 1
+            if oldest - 1 <= seq <= self.seq:
+                # Sequence numbers are consecutive, so the first wanted change sits at a known offset
+                return {
+                    'reset': False,
+                    'seq': self.seq,
+                    'changes': list(itertools.islice(self.changes, seq - oldest + 1, None)),
+                    'completion_percentage': self._completion()
+                }
+        return {'reset': True, **self.snapshot()}
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
+
+from executor import ExecutorSaturated
+
+class Job:
+    """One background job over a list of items, with per-item results and a progress event log"""
+    def __init__(self, session_id: str, total: int):
+        self.job_id = str(uuid.uuid4())
+        self.session_id = session_id
+        self.total = total
+        self.status = "queued"
+        self.completed = 0
+        self.failed = 0
+        self.results = [None] * total
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.task = None
+        self._events = []
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def publish(self, event: str, data: dict):
+        self._events.append((event, data))
+        # Wake every waiting listener, then arm a fresh event for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self):
+        while not self.done:
+            await self._changed.wait()
+
+    async def events(self):
+        """Server-sent events for this job, replaying earlier ones first"""
+        index = 0
+        while True:
+            while index < len(self._events):
+                event, data = self._events[index]
+                index += 1
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            if self.done:
+                return
+            await self._changed.wait()
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "session_id": self.session_id,
+            "status": self.status,
+            "images_total": self.total,
+            "images_completed": self.completed,
+            "images_failed": self.failed,
+            "progress": round((self.completed + self.failed) / self.total, 3) if self.total else 1.0,
+            "partial_results": self.results,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished
+        }
+
+class JobRegistry:
+    """Runs jobs as event-loop tasks, processing up to `concurrency` items of each job at once"""
+    def __init__(self, concurrency: int = 4, max_active: int = 8, max_jobs: int = 200):
+        self.concurrency = concurrency
+        self.max_active = max_active
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+    def active(self) -> int:
+        return sum(1 for job in self.jobs.values() if not job.done)
+
+    def submit(self, session_id: str, items: list, process_item, finalize) -> Job:
+        """Start a job; process_item(item) and finalize(results) are coroutines.
+
+        finalize only runs when every item succeeded, with results in item order.
+        Raises ExecutorSaturated when max_active jobs are already running.
+        """
+        if self.active() >= self.max_active:
+            raise ExecutorSaturated()
+        job = Job(session_id, len(items))
+        self.jobs[job.job_id] = job
+        # Forget the oldest finished jobs past the retention limit
+        for job_id in [job_id for job_id, old in self.jobs.items() if old.done][:max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[job_id]
+        job.task = asyncio.create_task(self._run(job, items, process_item, finalize))
+        return job
+
+    async def _run(self, job: Job, items: list, process_item, finalize):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_item(index, item):
+            async with semaphore:
+                try:
+                    job.results[index] = await process_item(item)
+                    job.completed += 1
+                    job.publish("image", {"index": index, "result": job.results[index],
+                                          "completed": job.completed, "total": job.total})
+                except Exception as e:
+                    job.failed += 1
+                    job.results[index] = {"error": str(e)}
+                    job.publish("image_failed", {"index": index, "error": str(e),
+                                                 "completed": job.completed, "total": job.total})
+
+        job.status = "running"
+        await asyncio.gather(*(run_item(index, item) for index, item in enumerate(items)))
+        try:
+            if job.failed:
+                raise RuntimeError(f"{job.failed} of {job.total} images failed")
+            job.result = await finalize(job.results)
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        job.finished = time.time()
+        job.publish(job.status, {"status": job.status, "result": job.result, "error": job.error})
+
+    def stats(self) -> dict:
+        return {"jobs": len(self.jobs), "active": self.active(), "concurrency": self.concurrency}
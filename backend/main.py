@@ -1,17 +1,43 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, WebSocket, WebSocketDisconnect, Request, Header
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from typing import List
-import shutil
+from typing import List, Optional
 import os
 import uuid
 from datetime import datetime
 import json
+import asyncio
+import secrets
+import threading
+import time
+from contextlib import asynccontextmanager
 
-from services import SegmentationService, CLIPService, MCPService
+from mcp_service import MCPService
+from scheduler import InferenceScheduler
+from executor import BoundedExecutor, ExecutorSaturated
+from tracking import IoUTracker
+from caching import BoundedLRUCache, perceptual_hash
+from motion import MotionGate, motion_thumbnail
+from session_store import open_session_store, open_session_objects
+from tool_matching import get_matcher
+from inventory import RunningInventory
+from jobs import JobRegistry
+import metrics
+from metrics import timed
+from profiling import SamplingProfiler, sampled
 
-app = FastAPI(title="Medical Crash Cart Validator API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load models off the event loop so the server accepts requests immediately
+    threading.Thread(target=load_models, name="model-loader", daemon=True).start()
+    yield
+    if scheduler is not None:
+        scheduler.detect_lane.close()
+        scheduler.classify_lane.close()
+    ml_executor.shutdown()
+
+app = FastAPI(title="Medical Crash Cart Validator API", version="1.0.0", lifespan=lifespan)
 
 # Add CORS middleware for frontend integration
 app.add_middleware(
@@ -22,21 +48,155 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Opt-in sampling profiler: X-Profile: 1, ?profile=1 or PROFILE_SAMPLE_RATE of requests
+profiler = SamplingProfiler()
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+if profiler.enabled and not ADMIN_TOKEN:
+    print("❌ PROFILING_ENABLED is set without ADMIN_TOKEN; /admin/profiles will refuse all requests")
+
+async def profile_requests(request: Request, call_next):
+    if not profiler.should_profile(request.headers, request.query_params):
+        return await call_next(request)
+    with profiler.profile(f"{request.method} {request.url.path}") as profile:
+        response = await call_next(request)
+    response.headers["X-Profile-Id"] = profile.file_name
+    return response
+
+# Only installed when enabled, so unprofiled deployments skip the middleware layer entirely
+if profiler.enabled:
+    app.middleware("http")(profile_requests)
+
 # Mount static files for serving images
 app.mount("/images", StaticFiles(directory="temp_images"), name="images")
 app.mount("/tool-images", StaticFiles(directory="../CLIP/tool_images"), name="tool_images")
 
-# Initialize services
-segmentation_service = SegmentationService()
-clip_service = CLIPService()
+# Initialize services; the ML models are filled in by load_models once the
+# lifespan hook has started it, everything else is usable right away
+segmentation_service = None
+clip_service = None
+scheduler = None
 mcp_service = MCPService()
+model_state = {"status": "loading", "error": None, "load_seconds": None}
+
+def load_models():
+    """Import the ML stack, load YOLO and CLIP, warm them up and publish them"""
+    global segmentation_service, clip_service, scheduler
+    started = time.monotonic()
+    try:
+        from services import SegmentationService, CLIPService
+        segmentation = SegmentationService()
+        clip = CLIPService()
+        
+        # One inference each so the first real request does not pay for lazy initialisation
+        segmentation.warm_up()
+        clip.warm_up()
+        
+        # Central scheduler that micro-batches YOLO and CLIP work across concurrent requests
+        if os.getenv('MICROBATCH_ENABLED', '1').lower() in ('1', 'true', 'yes'):
+            scheduler = InferenceScheduler(
+                segmentation, clip,
+                max_wait_ms=float(os.getenv('MICROBATCH_MAX_WAIT_MS', 15)),
+                max_frames=int(os.getenv('MICROBATCH_MAX_FRAMES', 8)),
+                # Only busy ML workers can join a batch, so stop waiting once they all have
+                submitters_fn=ml_executor.running
+            )
+        segmentation_service, clip_service = segmentation, clip
+        model_state.update(status="ready", load_seconds=round(time.monotonic() - started, 2))
+        print(f"✅ Models loaded and warmed up in {model_state['load_seconds']}s")
+    except Exception as e:
+        model_state.update(status="failed", error=str(e))
+        print(f"❌ Model loading failed: {e}")
+
+# Blocking model inference runs on a dedicated, size-bounded pool so the
+# event loop and the default threadpool stay free for lightweight endpoints
+ml_executor = BoundedExecutor(
+    max_workers=int(os.getenv('ML_WORKERS', 4)),
+    max_queue=int(os.getenv('ML_QUEUE_DEPTH', 16))
+)
+ML_RETRY_AFTER_SECONDS = int(os.getenv('ML_RETRY_AFTER', 2))
+
+# Executor slots all upload jobs together may hold; by default one worker is
+# always left free for /realtime-validate and the WebSocket
+UPLOAD_ML_SLOTS = min(int(os.getenv('UPLOAD_ML_SLOTS', max(1, ml_executor.max_workers - 1))),
+                      ml_executor.max_workers + ml_executor.max_queue - 1)
+upload_ml_slots = asyncio.Semaphore(max(1, UPLOAD_ML_SLOTS))
+
+# Background upload jobs; each job feeds several images to the ML executor at once
+upload_jobs = JobRegistry(
+    concurrency=int(os.getenv('UPLOAD_JOB_CONCURRENCY', 4)),
+    max_active=int(os.getenv('UPLOAD_MAX_ACTIVE_JOBS', 8))
+)
+
+def server_busy() -> HTTPException:
+    """503 returned when the ML executor queue is full"""
+    return HTTPException(
+        status_code=503,
+        detail="Inference queue is full, retry later",
+        headers={"Retry-After": str(ML_RETRY_AFTER_SECONDS)}
+    )
+
+def require_models():
+    """Raise 503 until the models are loaded and warmed up"""
+    if model_state["status"] != "ready":
+        raise HTTPException(
+            status_code=503,
+            detail=f"Models are not ready ({model_state['status']})",
+            headers={"Retry-After": str(ML_RETRY_AFTER_SECONDS)}
+        )
 
-# Storage for session data
-sessions = {}
+def segment(image, output_dir: str) -> dict:
+    """Segment an image, through the shared scheduler when enabled"""
+    if scheduler is not None:
+        return scheduler.segment(image, output_dir)
+    return segmentation_service.segment_image(image, output_dir)
+
+def classify(segmentation_result: dict) -> dict:
+    """Classify a segmentation result, through the shared scheduler when enabled"""
+    if scheduler is not None:
+        return scheduler.classify(segmentation_result)
+    return clip_service.classify_segmentation(segmentation_result)
+
+# Storage for session data (SESSION_STORE=memory|sqlite); live runtime objects
+# such as trackers and motion gates stay in this process, bounded like the sessions
+session_store = open_session_store()
+
+# Per-session object trackers for the realtime path (only new or changed objects are classified)
+TRACKING_ENABLED = os.getenv('TRACKING_ENABLED', '1').lower() in ('1', 'true', 'yes')
+trackers = open_session_objects()
+
+# Per-session motion gates: near-identical frames reuse the last result instead of running inference
+MOTION_GATE_ENABLED = os.getenv('MOTION_GATE_ENABLED', '1').lower() in ('1', 'true', 'yes')
+MOTION_THRESHOLD = float(os.getenv('MOTION_THRESHOLD', 3.0))
+MOTION_MAX_STALENESS = float(os.getenv('MOTION_MAX_STALENESS', 2.0))
+motion_gates = open_session_objects()
+
+# Recent frames kept in memory so annotated images can be rendered on request;
+# an entry holds (frame, frame_boxes, bounding_boxes) until rendered, then the JPEG bytes
+frame_cache = BoundedLRUCache(
+    max_entries=int(os.getenv('FRAME_CACHE_ENTRIES', 64)),
+    max_bytes=int(float(os.getenv('FRAME_CACHE_MB', 128)) * 1024 * 1024)
+)
+
+def remember_frame(segmentation_result: dict) -> str:
+    """Keep a frame and its boxes for lazy annotation and return its frame id"""
+    frame_id = uuid.uuid4().hex
+    frame = segmentation_result['frame']
+    frame_cache.put(frame_id, (frame, segmentation_result['frame_boxes'], segmentation_result['bounding_boxes']), frame.nbytes)
+    return frame_id
+
+# Per-session running inventories (cumulative uploads plus the live camera view)
+inventories = open_session_objects()
+
+def get_inventory(session_id: str, session_data: dict) -> RunningInventory:
+    inventory = inventories.get(session_id)
+    if inventory is None:
+        inventory = inventories.setdefault(session_id, RunningInventory(session_data["required_tools"]))
+    return inventory
 
 # --- Endpoint 1: Input procedure/emergency ---
 @app.post("/input-procedure")
-def input_procedure(procedure: str = Form(...)):
+@sampled
+def input_procedure(procedure: str = Form(...), archive_originals: bool = Form(False)):
     """Get required tools checklist for a medical procedure"""
     try:
         # Generate session ID
@@ -45,14 +205,19 @@ def input_procedure(procedure: str = Form(...)):
         # Get tools from MCP scraping service
         required_tools = mcp_service.get_procedure_tools(procedure)
         
+        # Compile the matching index once; later validations reuse it
+        get_matcher(required_tools)
+        
         # Store session data
-        sessions[session_id] = {
+        session_store.create(session_id, {
             "procedure": procedure,
             "required_tools": required_tools,
             "timestamp": datetime.now().isoformat(),
             "detected_tools": {},
-            "validation_complete": False
-        }
+            "validation_complete": False,
+            # Uploaded images are only written to disk when the session asks for it
+            "archive_originals": archive_originals
+        })
         
         return {
             "session_id": session_id,
@@ -64,114 +229,150 @@ def input_procedure(procedure: str = Form(...)):
         raise HTTPException(status_code=500, detail=str(e))
 
 # --- Endpoint 2: Upload and process images ---
+def process_uploaded_image(session_id: str, archive_originals: bool, filename: str, data: bytes):
+    """Segment and classify one uploaded image; None when no objects were detected"""
+    # Create unique directory for this session
+    upload_dir = f"uploaded_images/{session_id}"
+    os.makedirs(upload_dir, exist_ok=True)
+    
+    # Keep the original only when the session archives uploads
+    if archive_originals:
+        file_path = os.path.join(upload_dir, filename)
+        with open(file_path, "wb") as buffer:
+            buffer.write(data)
+    
+    # Segment objects straight from the uploaded bytes
+    crop_dir = f"{upload_dir}/cropped"
+    segmentation_result = segment(data, crop_dir)
+    
+    if not segmentation_result['crops']:
+        return None
+    
+    # Classify each detected object with CLIP straight from memory
+    classification_results = classify(segmentation_result)
+    frame_id = remember_frame(segmentation_result)
+    
+    return {
+        "filename": filename,
+        "objects_detected": segmentation_result['total_objects'],
+        "tool_counts": classification_results['tool_counts'],
+        "bounding_boxes": segmentation_result['bounding_boxes'],
+        "image_size": segmentation_result['image_size'],
+        "frame_id": frame_id,
+        "annotated_image_url": f"/frames/{frame_id}/annotated.jpg",
+        "annotated_image_path": segmentation_result['annotated_image_path']
+    }
+
+def aggregate_uploads(session_id: str, image_results: list, inventory: RunningInventory) -> dict:
+    """Sum per-image tool counts in upload order and store the totals on the session"""
+    all_detected_tools = {}
+    processed_images = [result for result in image_results if result is not None]
+    
+    # Aggregate tool counts
+    for image in processed_images:
+        for tool, count in image['tool_counts'].items():
+            all_detected_tools[tool] = all_detected_tools.get(tool, 0) + count
+    
+    # Update session with detected tools
+    session_store.update(session_id, detected_tools=all_detected_tools, processed_images=processed_images)
+    # Counted once the whole upload succeeded, so a failed job leaves the inventory untouched
+    inventory_seq = inventory.add("uploads", all_detected_tools)
+    
+    return {
+        "session_id": session_id,
+        "processed_images": processed_images,
+        "total_detected_tools": all_detected_tools,
+        "images_processed": len(image_results),
+        "inventory_seq": inventory_seq
+    }
+
+async def run_ml_waiting(fn, *args):
+    """Run on the ML executor, waiting for a free slot instead of failing (background jobs)"""
+    async with upload_ml_slots:
+        while True:
+            try:
+                return await ml_executor.run(fn, *args)
+            except ExecutorSaturated:
+                await asyncio.sleep(0.1)
+
 @app.post("/upload-images")
-def upload_images(session_id: str = Form(...), files: List[UploadFile] = File(...)):
-    """Upload images, segment objects, and classify them with CLIP"""
+async def upload_images(session_id: str = Form(...), files: List[UploadFile] = File(...), wait: bool = Form(False)):
+    """Upload images and start a background job that segments and classifies them with CLIP"""
     try:
-        if session_id not in sessions:
+        session_data = session_store.get(session_id)
+        if session_data is None:
             raise HTTPException(status_code=404, detail="Session not found")
-            
-        # Create unique directory for this session
-        upload_dir = f"uploaded_images/{session_id}"
-        os.makedirs(upload_dir, exist_ok=True)
-        
-        all_detected_tools = {}
-        processed_images = []
-        
-        for file in files:
-            # Save uploaded file
-            file_path = os.path.join(upload_dir, file.filename)
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            
-            # Segment objects from the image
-            crop_dir = f"{upload_dir}/cropped"
-            segmentation_result = segmentation_service.segment_image(file_path, crop_dir)
-            
-            if segmentation_result['cropped_paths']:
-                # Classify each cropped object with CLIP
-                classification_results = clip_service.classify_multiple_images(segmentation_result['cropped_paths'])
-                
-                # Aggregate tool counts
-                for tool, count in classification_results['tool_counts'].items():
-                    all_detected_tools[tool] = all_detected_tools.get(tool, 0) + count
-                
-                processed_images.append({
-                    "filename": file.filename,
-                    "objects_detected": segmentation_result['total_objects'],
-                    "tool_counts": classification_results['tool_counts'],
-                    "bounding_boxes": segmentation_result['bounding_boxes'],
-                    "annotated_image_path": segmentation_result['annotated_image_path']
-                })
-        
-        # Update session with detected tools
-        sessions[session_id]["detected_tools"] = all_detected_tools
-        sessions[session_id]["processed_images"] = processed_images
-        
-        return {
-            "session_id": session_id,
-            "processed_images": processed_images,
-            "total_detected_tools": all_detected_tools,
-            "images_processed": len(files)
-        }
-        
+        require_models()
+        
+        with timed('upload_read'):
+            uploads = [(file.filename, await file.read()) for file in files]
+        inventory = get_inventory(session_id, session_data)
+        archive_originals = session_data["archive_originals"]
+        
+        async def process_item(upload):
+            filename, data = upload
+            return await run_ml_waiting(process_uploaded_image, session_id, archive_originals, filename, data)
+        
+        async def finalize(image_results):
+            return await asyncio.to_thread(aggregate_uploads, session_id, image_results, inventory)
+        
+        job = upload_jobs.submit(session_id, uploads, process_item, finalize)
+        
+        # wait=true keeps the old blocking behaviour and response
+        if wait:
+            await job.wait()
+            if job.status != "done":
+                raise HTTPException(status_code=500, detail=job.error)
+            return job.result
+        
+        return JSONResponse({
+            "job_id": job.job_id,
+            "status": job.status,
+            "images_total": job.total,
+            "status_url": f"/jobs/{job.job_id}",
+            "events_url": f"/jobs/{job.job_id}/events"
+        }, status_code=202)
+        
+    except HTTPException:
+        raise
+    except ExecutorSaturated:
+        raise server_busy()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Upload job status, progress and per-image results so far"""
+    job = upload_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent events: one `image` event per finished image, then `done` or `failed`"""
+    job = upload_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(job.events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
 # --- Endpoint 3: Validate inventory ---
 @app.post("/validate-inventory")
+@sampled
 def validate_inventory(session_id: str = Form(...)):
     """Cross-reference detected tools with required tools and generate validation report"""
     try:
-        if session_id not in sessions:
+        session_data = session_store.get(session_id)
+        if session_data is None:
             raise HTTPException(status_code=404, detail="Session not found")
             
-        session_data = sessions[session_id]
         required_tools = session_data["required_tools"]
         detected_tools = session_data.get("detected_tools", {})
         
-        # Normalize tool names for comparison (lowercase, remove common words)
-        def normalize_tool_name(name):
-            return name.lower().replace("_", " ").strip()
-            
-        # Create normalized mappings
-        required_normalized = {normalize_tool_name(tool): tool for tool in required_tools}
-        detected_normalized = {}
-        for tool, count in detected_tools.items():
-            norm_name = normalize_tool_name(tool)
-            detected_normalized[norm_name] = detected_normalized.get(norm_name, 0) + count
-        
-        # Find matches, missing, and extra tools
-        matched_tools = {}
-        missing_tools = []
-        extra_tools = {}
-        
-        # Check required tools
-        for norm_req, orig_req in required_normalized.items():
-            if norm_req in detected_normalized:
-                matched_tools[orig_req] = detected_normalized[norm_req]
-            else:
-                # Check for partial matches
-                found_partial = False
-                for norm_det in detected_normalized.keys():
-                    if norm_req in norm_det or norm_det in norm_req:
-                        matched_tools[orig_req] = detected_normalized[norm_det]
-                        found_partial = True
-                        break
-                if not found_partial:
-                    missing_tools.append(orig_req)
-        
-        # Check for extra tools
-        for norm_det, count in detected_normalized.items():
-            if norm_det not in required_normalized:
-                # Check if it's a partial match we already counted
-                is_partial_match = False
-                for norm_req in required_normalized.keys():
-                    if norm_req in norm_det or norm_det in norm_req:
-                        is_partial_match = True
-                        break
-                if not is_partial_match:
-                    extra_tools[norm_det] = count
+        # Matched, missing and extra tools from the session's compiled matcher
+        with timed('validate'):
+            matched_tools, missing_tools, extra_tools = get_matcher(required_tools).match(detected_tools)
         
         # Calculate completion percentage
         total_required = len(required_tools)
@@ -208,8 +409,19 @@ def validate_inventory(session_id: str = Form(...)):
             "validation_timestamp": datetime.now().isoformat()
         }
         
-        sessions[session_id]["validation_result"] = validation_result
-        sessions[session_id]["validation_complete"] = True
+        session_store.update(session_id, validation_result=validation_result, validation_complete=True)
+        
+        # Append to the time-ordered validation log served by /logs
+        session_store.append_log({
+            "session_id": session_id,
+            "timestamp": session_data.get("timestamp"),
+            "procedure": session_data.get("procedure"),
+            "completion_percentage": validation_result["completion_percentage"],
+            "issues_count": len(issues),
+            "missing_tools": missing_tools,
+            "extra_tools": list(extra_tools.keys()),
+            "validation_timestamp": validation_result["validation_timestamp"]
+        })
         
         return JSONResponse(validation_result)
         
@@ -218,88 +430,255 @@ def validate_inventory(session_id: str = Form(...)):
 
 # --- Endpoint 4: Get session data ---
 @app.get("/session/{session_id}")
-def get_session(session_id: str):
-    """Get complete session data"""
-    if session_id not in sessions:
+@sampled
+def get_session(session_id: str, full: bool = False):
+    """Get session summary; full=true also returns the per-image results"""
+    session_data = session_store.get(session_id, include_blobs=full)
+    if session_data is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session_data
+
+@app.get("/session/{session_id}/inventory")
+@sampled
+def get_session_inventory(session_id: str, since: Optional[int] = None):
+    """Running inventory snapshot, or only the changes after sequence number `since`"""
+    session_data = session_store.get(session_id)
+    if session_data is None:
         raise HTTPException(status_code=404, detail="Session not found")
-    return sessions[session_id]
+    inventory = get_inventory(session_id, session_data)
+    if since is None:
+        return inventory.snapshot()
+    return inventory.changes_since(since)
 
 # --- Endpoint 5: Logs for dashboard ---
 @app.get("/logs")
-def get_logs():
-    """Get system logs and validation history"""
-    logs = []
-    for session_id, session_data in sessions.items():
-        if session_data.get("validation_complete"):
-            validation = session_data.get("validation_result", {})
-            log_entry = {
-                "session_id": session_id,
-                "timestamp": session_data.get("timestamp"),
-                "procedure": session_data.get("procedure"),
-                "completion_percentage": validation.get("completion_percentage", 0),
-                "issues_count": len(validation.get("issues", [])),
-                "missing_tools": validation.get("missing", []),
-                "extra_tools": list(validation.get("extra", {}).keys())
-            }
-            logs.append(log_entry)
-    
-    # Sort by timestamp (most recent first)
-    logs.sort(key=lambda x: x.get("timestamp", ""), reverse=True)
-    return {"logs": logs[:50]}  # Return last 50 entries
+@sampled
+def get_logs(limit: int = 50, cursor: Optional[int] = None,
+             procedure: Optional[str] = None, missing_tool: Optional[str] = None):
+    """Get validation history, newest first; pass next_cursor back as cursor for the next page"""
+    limit = max(1, min(limit, 200))
+    logs, next_cursor = session_store.logs(limit, cursor, procedure, missing_tool)
+    return {"logs": logs, "next_cursor": next_cursor}
 
 # --- Endpoint 6: Real-time validation (for live camera feed) ---
-@app.post("/realtime-validate")
-def realtime_validate(session_id: str = Form(...), image: UploadFile = File(...)):
-    """Process single image for real-time validation"""
-    try:
-        if session_id not in sessions:
-            raise HTTPException(status_code=404, detail="Session not found")
-            
-        # Save temporary image
+def subset_segmentation(segmentation_result: dict, indices: list) -> dict:
+    """Segmentation result restricted to the objects at the given indices"""
+    return {
+        'crops': [segmentation_result['crops'][i] for i in indices],
+        'frame': segmentation_result['frame'],
+        'frame_boxes': [segmentation_result['frame_boxes'][i] for i in indices],
+        'bounding_boxes': [segmentation_result['bounding_boxes'][i] for i in indices]
+    }
+
+def classify_tracked(session_id: str, segmentation_result: dict) -> dict:
+    """Track objects across frames, classify only new or changed ones and return voted tool counts"""
+    tracker = trackers.setdefault(session_id, IoUTracker())
+    boxes = [(box['x1'], box['y1'], box['x2'], box['y2']) for box in segmentation_result['bounding_boxes']]
+    appearances = [perceptual_hash(crop) for crop in segmentation_result['crops']]
+    
+    with tracker.lock:
+        tracks, needs_classification = tracker.update(boxes, appearances)
+        if needs_classification:
+            subset = subset_segmentation(segmentation_result, needs_classification)
+            predictions = classify(subset)['individual_results']
+            for i in needs_classification:
+                object_id = segmentation_result['bounding_boxes'][i]['object_id']
+                tracks[i].record(predictions[object_id], clip_service.confidence_threshold)
+        
+        for box, track in zip(segmentation_result['bounding_boxes'], tracks):
+            box['track_id'] = track.track_id
+            box['label'] = track.label
+        return tracker.visible_tool_counts()
+
+def process_realtime_frame(session_id: str, data: bytes) -> dict:
+    """Segment, classify and quick-validate one camera frame"""
+    with timed('realtime_frame'):
         temp_dir = f"temp_images/{session_id}"
-        os.makedirs(temp_dir, exist_ok=True)
-        temp_path = os.path.join(temp_dir, f"frame_{datetime.now().timestamp()}.jpg")
-        
-        with open(temp_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
+        session_data = session_store.get(session_id)
+        if session_data is None:
+            # Expired or evicted since the caller checked it
+            raise HTTPException(status_code=404, detail="Session not found")
         
-        # Quick segmentation and classification
+        # Archive the raw frame only when the session asks for it
+        if session_data.get("archive_originals"):
+            archive_dir = f"uploaded_images/{session_id}/frames"
+            os.makedirs(archive_dir, exist_ok=True)
+            with timed('disk_write'), open(os.path.join(archive_dir, f"frame_{datetime.now().timestamp()}.jpg"), "wb") as buffer:
+                buffer.write(data)
+        
+        # Skip inference entirely while the scene is static
+        gate = None
+        if MOTION_GATE_ENABLED:
+            gate = motion_gates.setdefault(session_id, MotionGate(MOTION_THRESHOLD, MOTION_MAX_STALENESS))
+            with timed('motion_gate'):
+                thumbnail = motion_thumbnail(data)
+                cached = gate.check(thumbnail)
+            if cached is not None:
+                return {**cached, "cached": True, "timestamp": datetime.now().isoformat()}
+        
+        # Quick segmentation and classification, decoded in memory
         crop_dir = f"{temp_dir}/cropped"
-        segmentation_result = segmentation_service.segment_image(temp_path, crop_dir)
+        segmentation_result = segment(data, crop_dir)
         
-        if segmentation_result['cropped_paths']:
-            results = clip_service.classify_multiple_images(segmentation_result['cropped_paths'])
+        if TRACKING_ENABLED:
+            detected_tools = classify_tracked(session_id, segmentation_result)
+        elif segmentation_result['crops']:
+            results = classify(segmentation_result)
             detected_tools = results['tool_counts']
         else:
             detected_tools = {}
         
         # Quick validation against required tools
-        required_tools = sessions[session_id]["required_tools"]
-        missing = [tool for tool in required_tools if tool.lower() not in [d.lower() for d in detected_tools.keys()]]
+        required_tools = session_data["required_tools"]
+        with timed('validate'):
+            missing = get_matcher(required_tools).missing_exact(detected_tools)
         
-        # Return the annotated image path for display (don't clean up)
-        annotated_image_url = f"/images/{session_id}/cropped/annotated_image.jpg"
+            # The camera's current view replaces its previous contribution to the running inventory
+            inventory_seq = get_inventory(session_id, session_data).replace("realtime", detected_tools)
         
-        # Clean up only the original temp file and cropped images
-        os.remove(temp_path)
+        # The annotated image is only rendered if the client fetches it
+        frame_id = remember_frame(segmentation_result)
+        
+        # Clean up any debug crops
         for crop_path in segmentation_result['cropped_paths']:
             if os.path.exists(crop_path):
                 os.remove(crop_path)
         
-        return {
+        result = {
             "detected_tools": detected_tools,
             "missing_tools": missing,
             "objects_found": segmentation_result['total_objects'],
             "bounding_boxes": segmentation_result['bounding_boxes'],
-            "annotated_image_url": annotated_image_url,
+            "image_size": segmentation_result['image_size'],
+            "frame_id": frame_id,
+            "annotated_image_url": f"/frames/{frame_id}/annotated.jpg",
+            "cached": False,
+            "inventory_seq": inventory_seq,
             "timestamp": datetime.now().isoformat()
         }
+        if gate is not None:
+            gate.store(thumbnail, result)
+        return result
+
+@app.post("/realtime-validate")
+async def realtime_validate(session_id: str = Form(...), image: UploadFile = File(...)):
+    """Process single image for real-time validation"""
+    try:
+        if session_id not in session_store:
+            raise HTTPException(status_code=404, detail="Session not found")
+        require_models()
+        
+        with timed('upload_read'):
+            data = await image.read()
+        return await ml_executor.run(process_realtime_frame, session_id, data)
         
+    except HTTPException:
+        raise
+    except ExecutorSaturated:
+        raise server_busy()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- Live validation over a WebSocket ---
+def compact_frame_message(seq: int, dropped: int, result: dict) -> str:
+    """Short-keyed JSON for a processed frame: boxes are [x1, y1, x2, y2, confidence] in a [width, height] image"""
+    return json.dumps({
+        "type": "result",
+        "seq": seq,
+        "dropped": dropped,
+        "det": result["detected_tools"],
+        "miss": result["missing_tools"],
+        "n": result["objects_found"],
+        "boxes": [
+            [box["x1"], box["y1"], box["x2"], box["y2"], round(box["confidence"], 3)]
+            for box in result["bounding_boxes"]
+        ],
+        "size": [result["image_size"]["width"], result["image_size"]["height"]],
+        "ts": result["timestamp"]
+    }, separators=(",", ":"))
+
+@app.websocket("/ws/validate/{session_id}")
+async def ws_validate(websocket: WebSocket, session_id: str):
+    """Stream binary JPEG frames in, push detections back; stale frames are dropped, not queued"""
+    await websocket.accept()
+    if session_id not in session_store:
+        await websocket.close(code=4404, reason="Session not found")
+        return
+    if model_state["status"] != "ready":
+        await websocket.close(code=1013, reason="Models are not ready, retry later")
+        return
+    
+    # Single-slot mailbox: a new frame replaces one that has not been picked up yet
+    latest = {"data": None, "seq": 0}
+    dropped = 0
+    frame_ready = asyncio.Event()
+    
+    async def receive_frames():
+        nonlocal dropped
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            data = message.get("bytes")
+            if not data:
+                continue
+            if latest["data"] is not None:
+                dropped += 1
+            latest["data"] = data
+            latest["seq"] += 1
+            frame_ready.set()
+    
+    async def process_frames():
+        while True:
+            await frame_ready.wait()
+            frame_ready.clear()
+            data, seq = latest["data"], latest["seq"]
+            latest["data"] = None
+            if data is None:
+                continue
+            try:
+                result = await ml_executor.run(process_realtime_frame, session_id, data)
+                message = compact_frame_message(seq, dropped, result)
+            except ExecutorSaturated:
+                message = json.dumps({"type": "busy", "seq": seq, "retry_after": ML_RETRY_AFTER_SECONDS})
+            except HTTPException as e:
+                # The session expired while streaming
+                await websocket.close(code=4404, reason=e.detail)
+                return
+            except Exception as e:
+                message = json.dumps({"type": "error", "seq": seq, "detail": str(e)})
+            await websocket.send_text(message)
+    
+    tasks = [asyncio.create_task(receive_frames()), asyncio.create_task(process_frames())]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            exc = task.exception()
+            if exc is not None and not isinstance(exc, (WebSocketDisconnect, RuntimeError)):
+                print(f"WebSocket session {session_id} failed: {exc}")
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# --- Annotated frames, rendered on request ---
+@app.get("/frames/{frame_id}/annotated.jpg")
+@sampled
+def get_annotated_frame(frame_id: str):
+    """Frame with its detections drawn, rendered on first request and cached as JPEG"""
+    entry = frame_cache.get(frame_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Frame not found or expired")
+    if isinstance(entry, bytes):
+        return Response(content=entry, media_type="image/jpeg")
+    from services import render_annotated_jpeg
+    frame, frame_boxes, bounding_boxes = entry
+    jpeg = render_annotated_jpeg(frame, frame_boxes, bounding_boxes)
+    frame_cache.put(frame_id, jpeg, len(jpeg))
+    return Response(content=jpeg, media_type="image/jpeg")
+
 # --- Endpoint 8: Get tool reference images ---
 @app.get("/tool-reference")
+@sampled
 def get_tool_reference():
     """Get list of reference tool images with their names"""
     try:
@@ -331,8 +710,131 @@ def get_tool_reference():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- Refresh reference gallery index ---
+@app.post("/gallery/refresh")
+async def refresh_gallery():
+    """Embed reference images newly added to CLIP/tool_images into the kNN gallery index"""
+    try:
+        require_models()
+        if clip_service.gallery_weight <= 0:
+            raise HTTPException(status_code=400, detail="Reference gallery is disabled (set CLIP_GALLERY_WEIGHT)")
+        changes = await ml_executor.run(clip_service.refresh_gallery)
+        return {
+            "added": changes['added'],
+            "removed": changes['removed'],
+            "total_images": len(clip_service.gallery) if clip_service.gallery else 0,
+            "classes": clip_service.gallery.class_names if clip_service.gallery else []
+        }
+    except HTTPException:
+        raise
+    except ExecutorSaturated:
+        raise server_busy()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# --- Pipeline statistics ---
+def motion_gate_stats() -> dict:
+    """Motion gate hits and misses summed over all sessions"""
+    skipped = sum(gate.skipped for gate in motion_gates.values())
+    processed = sum(gate.processed for gate in motion_gates.values())
+    total = skipped + processed
+    return {
+        "sessions": len(motion_gates),
+        "skipped": skipped,
+        "processed": processed,
+        "skip_rate": skipped / total if total else 0.0,
+        "threshold": MOTION_THRESHOLD,
+        "max_staleness_s": MOTION_MAX_STALENESS
+    }
+
+@app.get("/stats")
+async def get_stats():
+    """Counters for the inference pipeline caches and micro-batching scheduler"""
+    cache = clip_service.embedding_cache if clip_service is not None else None
+    return {
+        "models": model_state,
+        "clip_model_version": clip_service.model_version if clip_service is not None else None,
+        "clip_cache": cache.stats() if cache is not None else None,
+        "scheduler": scheduler.stats() if scheduler is not None else None,
+        "ml_executor": ml_executor.stats(),
+        "sessions": session_store.stats(),
+        "upload_jobs": upload_jobs.stats(),
+        "frame_cache": frame_cache.stats(),
+        "motion_gate": motion_gate_stats() if MOTION_GATE_ENABLED else None
+    }
+
+# --- Prometheus metrics ---
+def register_metrics():
+    """Expose cache, queue and gate counters that are read at scrape time"""
+    def cache_samples(field):
+        samples = [({"cache": "frames"}, frame_cache.stats()[field])]
+        if clip_service is not None and clip_service.embedding_cache is not None:
+            samples.append(({"cache": "clip_embeddings"}, clip_service.embedding_cache.stats()[field]))
+        return samples
+    
+    metrics.register("surgiscan_cache_hits_total", "counter", "Cache hits", lambda: cache_samples("hits"))
+    metrics.register("surgiscan_cache_misses_total", "counter", "Cache misses", lambda: cache_samples("misses"))
+    metrics.register("surgiscan_ml_executor_in_flight", "gauge", "Jobs running or queued on the ML executor",
+                     lambda: ml_executor.stats()["in_flight"])
+    metrics.register("surgiscan_ml_executor_queued", "gauge", "Jobs waiting for an ML worker",
+                     lambda: ml_executor.stats()["queued"])
+    metrics.register("surgiscan_ml_executor_rejected_total", "counter", "Requests rejected with 503",
+                     lambda: ml_executor.rejected)
+    metrics.register("surgiscan_upload_jobs_active", "gauge", "Upload jobs still running",
+                     upload_jobs.active)
+    metrics.register("surgiscan_scheduler_queue_depth", "gauge", "Items waiting in a micro-batching lane",
+                     lambda: None if scheduler is None else [
+                         ({"lane": "detect"}, scheduler.detect_lane.queue_depth()),
+                         ({"lane": "classify"}, scheduler.classify_lane.queue_depth())
+                     ])
+    metrics.register("surgiscan_models_ready", "gauge", "1 once the models are loaded and warmed up",
+                     lambda: int(model_state["status"] == "ready"))
+    if MOTION_GATE_ENABLED:
+        metrics.register("surgiscan_motion_gate_frames_total", "counter", "Realtime frames by motion gate decision",
+                         lambda: [({"decision": "skipped"}, sum(g.skipped for g in motion_gates.values())),
+                                  ({"decision": "processed"}, sum(g.processed for g in motion_gates.values()))])
+
+if metrics.METRICS_ENABLED:
+    register_metrics()
+
+@app.get("/metrics")
+async def get_metrics():
+    """Stage latencies, batch sizes, cache and queue counters in Prometheus text format"""
+    if not metrics.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled (set METRICS_ENABLED=1)")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# --- Request profiles ---
+def check_admin(token):
+    # Profiles expose code paths and timings, so collecting them requires a configured token
+    if not ADMIN_TOKEN:
+        if profiler.enabled:
+            raise HTTPException(status_code=403, detail="Set ADMIN_TOKEN to read profiles")
+        return
+    if not secrets.compare_digest(token or '', ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.get("/admin/profiles")
+def list_profiles(x_admin_token: Optional[str] = Header(None)):
+    """Recent request profiles, newest first"""
+    check_admin(x_admin_token)
+    profiles = sorted(profiler.list_profiles(), key=lambda p: p["modified"], reverse=True)
+    for profile in profiles:
+        profile["url"] = f"/admin/profiles/{profile['name']}"
+    return {"enabled": profiler.enabled, "profiles": profiles}
+
+@app.get("/admin/profiles/{name}")
+def get_profile(name: str, x_admin_token: Optional[str] = Header(None)):
+    """One profile as folded stacks (input for flamegraph.pl or speedscope)"""
+    check_admin(x_admin_token)
+    path = profiler.profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="text/plain")
+
 # --- Endpoint 7: Get crops analysis ---
 @app.get("/crops-analysis")
+@sampled
 def get_crops_analysis():
     """Get analysis of unique crops from detr_output_smoothed folder"""
     try:
@@ -387,20 +889,38 @@ def get_crops_analysis():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- Liveness and readiness ---
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the API process is up"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: models are loaded and warmed up"""
+    if model_state["status"] != "ready":
+        return JSONResponse({"ready": False, **model_state}, status_code=503)
+    return {"ready": True, **model_state}
+
 # --- Health check ---
 @app.get("/")
-def root():
+async def root():
     """API health check and status"""
     return {
         "status": "Medical Crash Cart Validator API is running",
         "version": "1.0.0",
         "endpoints": [
             "POST /input-procedure - Start new procedure validation session",
-            "POST /upload-images - Upload and process crash cart images",
+            "POST /upload-images - Upload crash cart images (background job)",
+            "GET /jobs/{job_id} - Upload job progress and results",
+            "GET /jobs/{job_id}/events - Upload job progress as server-sent events",
             "POST /validate-inventory - Cross-reference detected vs required tools",
             "POST /realtime-validate - Real-time single image validation",
+            "WS /ws/validate/{session_id} - Live validation over a WebSocket (binary JPEG frames)",
             "GET /session/{session_id} - Get session data",
-            "GET /logs - Get validation history logs"
+            "GET /logs - Get validation history logs",
+            "GET /healthz - Liveness probe",
+            "GET /readyz - Readiness probe (models loaded and warmed up)"
         ],
         "services": {
             "segmentation": "YOLO object detection",
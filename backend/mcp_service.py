@@ -0,0 +1,55 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'MCP-scraping'))
+
+class MCPService:
+    def __init__(self):
+        try:
+            from tool_requirement_agent import ToolRequirementAgent
+            self.agent = ToolRequirementAgent()
+        except ImportError:
+            print("MCP scraping agent not available, using fallback")
+            self.agent = None
+            
+    def get_procedure_tools(self, procedure: str) -> list:
+        """Get required tools for a medical procedure"""
+        if self.agent:
+            try:
+                result = self.agent.get_procedure_tools(procedure)
+                if 'tools_needed' in result:
+                    return result['tools_needed']
+                elif 'crash_cart_tools' in result:
+                    return result['crash_cart_tools']
+            except Exception as e:
+                print(f"Error getting tools from MCP agent: {e}")
+                
+        # Fallback tool lists for common procedures
+        fallback_tools = {
+            "code blue": [
+                "defibrillator", "oxygen mask", "ambu bag", "iv catheter", 
+                "syringe", "epinephrine", "atropine", "cardiac monitor"
+            ],
+            "intubation": [
+                "laryngoscope", "endotracheal tube", "ambu bag", "oxygen mask",
+                "suction catheter", "stylet", "syringe"
+            ],
+            "cardiac arrest": [
+                "defibrillator", "oxygen mask", "ambu bag", "iv catheter",
+                "syringe", "epinephrine", "atropine", "cardiac monitor"
+            ],
+            "trauma": [
+                "gauze", "bandage", "iv catheter", "syringe", "saline",
+                "blood pressure cuff", "stethoscope", "splint"
+            ]
+        }
+        
+        procedure_lower = procedure.lower()
+        for key, tools in fallback_tools.items():
+            if key in procedure_lower:
+                return tools
+                
+        # Default emergency tools
+        return [
+            "stethoscope", "blood pressure cuff", "syringe", "iv catheter",
+            "gauze", "bandage", "oxygen mask", "defibrillator"
+        ]
@@ -0,0 +1,113 @@
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+# Instrumentation switch; when off every hook below is a constant-time no-op
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1').lower() in ('1', 'true', 'yes')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+class Histogram:
+    """Cumulative-bucket histogram with one label, rendered in Prometheus text format"""
+    def __init__(self, name: str, help_text: str, label: str, buckets: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series = {}  # label value -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {label_value: list(values) for label_value, values in self._series.items()}
+        for label_value, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values[:-1]):
+                cumulative += count
+                labels = _format_labels({self.label: label_value, 'le': bound})
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels({self.label: label_value})
+            lines.append(f'{self.name}_sum{labels} {values[-1]}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+stage_seconds = Histogram('surgiscan_stage_seconds', 'Latency of validation pipeline stages', 'stage', LATENCY_BUCKETS)
+objects_per_frame = Histogram('surgiscan_objects_per_frame', 'Objects detected per frame', 'source', COUNT_BUCKETS)
+batch_size = Histogram('surgiscan_batch_size', 'Items per batched model call', 'lane', COUNT_BUCKETS)
+
+# Pull-style metrics read from other components at scrape time: name -> (type, help, fn)
+# where fn returns a number or a list of (labels dict, number)
+_collectors = {}
+
+def register(name: str, metric_type: str, help_text: str, fn):
+    _collectors[name] = (metric_type, help_text, fn)
+
+def observe_stage(stage: str, seconds: float):
+    if METRICS_ENABLED:
+        stage_seconds.observe(stage, seconds)
+
+def observe_objects(source: str, count: int):
+    if METRICS_ENABLED:
+        objects_per_frame.observe(source, count)
+
+def observe_batch(lane: str, size: int):
+    if METRICS_ENABLED:
+        batch_size.observe(lane, size)
+
+class _Timer:
+    __slots__ = ('stage', 'started')
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stage_seconds.observe(self.stage, time.perf_counter() - self.started)
+        return False
+
+_NULL_TIMER = contextlib.nullcontext()
+
+def timed(stage: str):
+    """Context manager recording the block's latency under the given stage"""
+    return _Timer(stage) if METRICS_ENABLED else _NULL_TIMER
+
+def render() -> str:
+    """All metrics in Prometheus text exposition format"""
+    lines = []
+    for histogram in (stage_seconds, objects_per_frame, batch_size):
+        lines.extend(histogram.render())
+    for name, (metric_type, help_text, fn) in sorted(_collectors.items()):
+        try:
+            value = fn()
+        except Exception as e:
+            print(f"❌ Metric {name} failed: {e}")
+            continue
+        if value is None:
+            continue
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        samples = value if isinstance(value, list) else [({}, value)]
+        for labels, sample in samples:
+            lines.append(f'{name}{_format_labels(labels)} {float(sample)}')
+    return '\n'.join(lines) + '\n'
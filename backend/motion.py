@@ -0,0 +1,52 @@
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Thumbnail size used for frame differencing
+THUMBNAIL_SIZE = (64, 48)
+
+def motion_thumbnail(data: bytes) -> np.ndarray:
+    """Small grayscale thumbnail of an encoded frame, decoded at 1/8 scale for JPEGs"""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        raise ValueError("Could not decode image bytes")
+    return cv2.resize(image, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+
+class MotionGate:
+    """Reuses the last full result while frames stay nearly identical to the last processed one"""
+    def __init__(self, threshold: float = 3.0, max_staleness: float = 2.0):
+        # Mean absolute grayscale difference (0-255) below which a frame counts as static
+        self.threshold = threshold
+        # Seconds after which a full pass is forced even for a static scene
+        self.max_staleness = max_staleness
+        self.lock = threading.Lock()
+        self._thumbnail = None
+        self._result = None
+        self._processed_at = 0.0
+        self.skipped = 0
+        self.processed = 0
+
+    def check(self, thumbnail: np.ndarray):
+        """Return the cached result if the frame can skip inference, otherwise None"""
+        with self.lock:
+            if self._thumbnail is None or self._result is None:
+                self.processed += 1
+                return None
+            if time.monotonic() - self._processed_at > self.max_staleness:
+                self.processed += 1
+                return None
+            if cv2.absdiff(thumbnail, self._thumbnail).mean() >= self.threshold:
+                self.processed += 1
+                return None
+            self.skipped += 1
+            return self._result
+
+    def store(self, thumbnail: np.ndarray, result: dict):
+        """Remember a fully processed frame and its result"""
+        with self.lock:
+            self._thumbnail = thumbnail
+            self._result = result
+            self._processed_at = time.monotonic()
+
@@ -0,0 +1,172 @@
+import contextlib
+import contextvars
+import functools
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+# Profile of the request being handled, inherited by tasks and executor jobs it starts
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+class RequestProfile:
+    """Folded stack samples of the threads doing work for one request"""
+    def __init__(self, label: str):
+        self.profile_id = uuid.uuid4().hex[:12]
+        self.label = label
+        self.started = time.time()
+        self.active = True
+        self.threads = {}  # thread id -> number of nested attachments
+        self.counts = {}  # folded stack -> samples
+        self.samples = 0
+        self.file_name = None
+        self.lock = threading.Lock()
+
+    def attach(self, thread_id: int):
+        with self.lock:
+            self.threads[thread_id] = self.threads.get(thread_id, 0) + 1
+
+    def detach(self, thread_id: int):
+        with self.lock:
+            remaining = self.threads.get(thread_id, 0) - 1
+            if remaining > 0:
+                self.threads[thread_id] = remaining
+            else:
+                self.threads.pop(thread_id, None)
+
+    def sample(self, frames: dict):
+        with self.lock:
+            thread_ids = list(self.threads)
+        for thread_id in thread_ids:
+            frame = frames.get(thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            folded = ';'.join(reversed(stack))
+            with self.lock:
+                self.counts[folded] = self.counts.get(folded, 0) + 1
+                self.samples += 1
+
+class SamplingProfiler:
+    """Stack-sampling profiler for selected requests, writing flamegraph-compatible folded stacks"""
+    def __init__(self, enabled: bool = None, sample_rate: float = None, interval_ms: float = None,
+                 profile_dir: str = None, max_profiles: int = None):
+        if enabled is None:
+            enabled = os.getenv('PROFILING_ENABLED', '0').lower() in ('1', 'true', 'yes')
+        self.enabled = enabled
+        # Fraction of requests profiled even without the header or query flag
+        self.sample_rate = sample_rate if sample_rate is not None else float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+        self.interval = (interval_ms or float(os.getenv('PROFILE_INTERVAL_MS', 5))) / 1000.0
+        self.profile_dir = profile_dir or os.getenv('PROFILE_DIR', 'profiles')
+        self.max_profiles = max_profiles or int(os.getenv('PROFILE_MAX_FILES', 50))
+        self._active = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def should_profile(self, headers, query_params) -> bool:
+        if not self.enabled:
+            return False
+        if headers.get('x-profile', '').lower() in ('1', 'true', 'yes'):
+            return True
+        if query_params.get('profile', '').lower() in ('1', 'true', 'yes'):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _run(self):
+        while True:
+            with self._lock:
+                profiles = list(self._active)
+                if not profiles:
+                    self._thread = None
+                    return
+            frames = sys._current_frames()
+            for profile in profiles:
+                profile.sample(frames)
+            time.sleep(self.interval)
+
+    @contextlib.contextmanager
+    def profile(self, label: str):
+        """Profile everything attached to this context until the block exits"""
+        profile = RequestProfile(label)
+        token = current_profile.set(profile)
+        with self._lock:
+            self._active.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+        try:
+            yield profile
+        finally:
+            current_profile.reset(token)
+            with self._lock:
+                self._active.discard(profile)
+            profile.active = False
+            self._save(profile)
+
+    def _save(self, profile: RequestProfile):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', profile.label).strip('_')[:60]
+        name = f"{time.strftime('%Y%m%dT%H%M%S', time.localtime(profile.started))}_{slug}_{profile.profile_id}.folded"
+        with profile.lock:
+            lines = [f"{stack} {count}" for stack, count in sorted(profile.counts.items())]
+        with open(os.path.join(self.profile_dir, name), 'w') as f:
+            f.write('\n'.join(lines) + ('\n' if lines else ''))
+        profile.file_name = name
+
+        # Keep only the newest max_profiles files
+        profiles = sorted(self.list_profiles(), key=lambda p: p['modified'])
+        for old in profiles[:max(0, len(profiles) - self.max_profiles)]:
+            try:
+                os.remove(os.path.join(self.profile_dir, old['name']))
+            except FileNotFoundError:
+                pass
+
+    def list_profiles(self) -> list:
+        if not os.path.isdir(self.profile_dir):
+            return []
+        profiles = []
+        for name in os.listdir(self.profile_dir):
+            if name.endswith('.folded'):
+                stat = os.stat(os.path.join(self.profile_dir, name))
+                profiles.append({'name': name, 'bytes': stat.st_size, 'modified': stat.st_mtime})
+        return profiles
+
+    def profile_path(self, name: str):
+        """Path of a stored profile, or None for unknown or unsafe names"""
+        if os.path.basename(name) != name or not name.endswith('.folded'):
+            return None
+        path = os.path.join(self.profile_dir, name)
+        return path if os.path.exists(path) else None
+
+@contextlib.contextmanager
+def sampled_thread(profiles=None):
+    """Attach the calling thread to the given profiles (default: the current request's), if any are active"""
+    if profiles is None:
+        profiles = [current_profile.get()]
+    profiles = [profile for profile in profiles if profile is not None and profile.active]
+    if not profiles:
+        yield
+        return
+    thread_id = threading.get_ident()
+    for profile in profiles:
+        profile.attach(thread_id)
+    try:
+        yield
+    finally:
+        for profile in profiles:
+            profile.detach(thread_id)
+
+def sampled(fn):
+    """Decorator for sync endpoints: sample the threadpool thread running them for profiled requests"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with sampled_thread():
+            return fn(*args, **kwargs)
+    return wrapper
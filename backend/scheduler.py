@@ -0,0 +1,158 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import observe_stage, observe_batch
+from profiling import current_profile, sampled_thread
+
+class _Pending:
+    __slots__ = ('item', 'future', 'enqueued', 'profile')
+
+    def __init__(self, item):
+        self.item = item
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        # Profile of the submitting request, so the lane thread is sampled for it too
+        self.profile = current_profile.get()
+
+class MicroBatcher:
+    """Queue work items from many request threads and run them through one batch function.
+
+    A batch is closed when it reaches max_batch_size or when the oldest item
+    has waited max_wait_ms, whichever comes first. Submitters block on their
+    result, so when submitters_fn reports how many threads could currently
+    submit, a batch is also closed as soon as all of them are in it.
+    """
+    def __init__(self, name: str, batch_fn, max_batch_size: int = 16, max_wait_ms: float = 15.0,
+                 submitters_fn=None):
+        self.name = name
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.submitters_fn = submitters_fn
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+        self._thread = threading.Thread(target=self._run, name=f"microbatch-{name}", daemon=True)
+        self._thread.start()
+
+    def _reset_stats(self):
+        self.batches = 0
+        self.items = 0
+        self.batch_sizes = {}
+        self.total_wait = 0.0
+        self.max_wait_seen = 0.0
+
+    def submit(self, item) -> Future:
+        """Queue one item and return a future for its result"""
+        pending = _Pending(item)
+        self._queue.put(pending)
+        return pending.future
+
+    def __call__(self, item):
+        """Queue one item and block until its batch has run"""
+        return self.submit(item).result()
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def close(self):
+        self._queue.put(None)
+
+    def _collect(self, first):
+        """Gather items until the batch is full or the first item's deadline passes"""
+        batch = [first]
+        deadline = first.enqueued + self.max_wait
+        stop = False
+        while len(batch) < self.max_batch_size:
+            if self.submitters_fn is not None and self._queue.empty() and len(batch) >= self.submitters_fn():
+                # Nobody else can add to this batch before the deadline
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if pending is None:
+                stop = True
+                break
+            batch.append(pending)
+        return batch, stop
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch, stop = self._collect(first)
+
+            started = time.monotonic()
+            waits = [started - pending.enqueued for pending in batch]
+            with self._stats_lock:
+                self.batches += 1
+                self.items += len(batch)
+                self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+                self.total_wait += sum(waits)
+                self.max_wait_seen = max(self.max_wait_seen, max(waits))
+            observe_batch(f'{self.name}_lane', len(batch))
+            for wait in waits:
+                observe_stage(f'{self.name}_queue_wait', wait)
+
+            profiles = {pending.profile for pending in batch if pending.profile is not None}
+            try:
+                with sampled_thread(profiles):
+                    results = self.batch_fn([pending.item for pending in batch])
+                for pending, result in zip(batch, results):
+                    pending.future.set_result(result)
+            except Exception as e:
+                for pending in batch:
+                    pending.future.set_exception(e)
+            if stop:
+                return
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                'batches': self.batches,
+                'items': self.items,
+                'mean_batch_size': self.items / self.batches if self.batches else 0.0,
+                'batch_size_histogram': dict(sorted(self.batch_sizes.items())),
+                'mean_queue_wait_ms': 1000 * self.total_wait / self.items if self.items else 0.0,
+                'max_queue_wait_ms': 1000 * self.max_wait_seen,
+                'queue_depth': self.queue_depth(),
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': 1000 * self.max_wait
+            }
+
+class InferenceScheduler:
+    """Shared YOLO and CLIP lanes that batch frames and crops across concurrent sessions"""
+    def __init__(self, segmentation_service, clip_service, max_wait_ms: float = 15.0,
+                 max_frames: int = 8, max_classify_frames: int = 16, submitters_fn=None):
+        self.segmentation_service = segmentation_service
+        self.clip_service = clip_service
+        self.detect_lane = MicroBatcher('detect', self._detect_batch, max_frames, max_wait_ms, submitters_fn)
+        self.classify_lane = MicroBatcher('classify', clip_service.classify_segmentations, max_classify_frames,
+                                          max_wait_ms, submitters_fn)
+
+    def _detect_batch(self, items: list) -> list:
+        frames = [frame for frame, _ in items]
+        output_dirs = [output_dir for _, output_dir in items]
+        return self.segmentation_service.segment_frames(frames, output_dirs)
+
+    def segment(self, image, output_dir: str = "cropped_objects") -> dict:
+        """Decode in the calling thread, then detect as part of a shared YOLO batch"""
+        frame = self.segmentation_service.decode(image)
+        return self.detect_lane((frame, output_dir))
+
+    def classify(self, segmentation_result: dict) -> dict:
+        """Classify a frame's objects as part of a shared CLIP batch"""
+        return self.classify_lane(segmentation_result)
+
+    def stats(self) -> dict:
+        return {
+            'detect': self.detect_lane.stats(),
+            'classify': self.classify_lane.stats()
+        }
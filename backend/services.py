@@ -8,64 +8,263 @@ import torch
 import open_clip
 from PIL import Image
 import pickle
+import json
+import hashlib
+import threading
 import cv2
 from ultralytics import YOLO
 import numpy as np
 
+from caching import BoundedLRUCache, perceptual_hash
+# MCPService lives in its own module so it can be used without importing torch
+from mcp_service import MCPService
+from metrics import timed, observe_objects, observe_batch
+
 # Import CLIP inference functions
-from clip_inference import load_trained_model, classify_image
+from clip_inference import (
+    load_trained_model, load_text_features, model_fingerprint, weights_fingerprint,
+    quantization_report_path, quantize_image_tower
+)
+from clip_export_onnx import onnx_model_path, onnx_metadata_path
+from clip_gallery import GalleryIndex, gallery_scores
+
+def decode_image_bytes(data: bytes) -> np.ndarray:
+    """Decode encoded image bytes (JPEG/PNG/...) into a BGR array without touching disk"""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode image bytes")
+    return image
+
+# libjpeg can scale by 1/2, 1/4 or 1/8 while decoding, in the DCT domain
+_REDUCED_COLOR_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# JPEG start-of-frame markers, the ones that carry the image dimensions
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def jpeg_size(data: bytes):
+    """Read (width, height) from a JPEG header, or return None if data is not a JPEG"""
+    if data[:2] != b'\xff\xd8':
+        return None
+    offset = 2
+    while offset + 9 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:  # fill byte
+            offset += 1
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height = int.from_bytes(data[offset + 5:offset + 7], 'big')
+            width = int.from_bytes(data[offset + 7:offset + 9], 'big')
+            return width, height
+        offset += 2 + int.from_bytes(data[offset + 2:offset + 4], 'big')
+    return None
+
+def _reduction_factor(long_side: int, target_size: int) -> int:
+    """Largest DCT reduction factor that keeps the long side at or above target_size"""
+    for factor in (8, 4, 2):
+        if long_side // factor >= target_size:
+            return factor
+    return 1
+
+def _level(image: np.ndarray, original_size: tuple) -> tuple:
+    """Pair a decoded level with its (x, y) scale back to original-image pixels and the oriented original size"""
+    original_w, original_h = original_size
+    h, w = image.shape[:2]
+    # EXIF orientation may have rotated the decoded image relative to the header
+    if (w > h) != (original_w > original_h):
+        original_w, original_h = original_h, original_w
+    return image, (original_w / w, original_h / h), (original_w, original_h)
+
+def decode_frame(data: bytes, detect_size: int = 640, crop_size: int = 1280) -> dict:
+    """Decode an upload into a detector-sized level and a medium crop level, without a full-size bitmap when possible"""
+    size = jpeg_size(data)
+    if size is None:
+        # Not a JPEG: no DCT scaling available, use one full-resolution level
+        image = decode_image_bytes(data)
+        h, w = image.shape[:2]
+        return {
+            'detect_image': image, 'detect_scale': (1.0, 1.0),
+            'crop_image': image, 'crop_scale': (1.0, 1.0),
+            'original_size': (w, h)
+        }
+    
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    long_side = max(size)
+    crop_factor = _reduction_factor(long_side, crop_size)
+    detect_factor = _reduction_factor(long_side, detect_size)
+    
+    crop_image = cv2.imdecode(buffer, _REDUCED_COLOR_FLAGS[crop_factor])
+    if crop_image is None:
+        raise ValueError("Could not decode image bytes")
+    if detect_factor == crop_factor:
+        detect_image = crop_image
+    else:
+        detect_image = cv2.imdecode(buffer, _REDUCED_COLOR_FLAGS[detect_factor])
+    
+    # Sizes and scales follow the decoded orientation, not the JPEG header
+    crop_image, crop_scale, original_size = _level(crop_image, size)
+    detect_image, detect_scale, _ = _level(detect_image, size)
+    return {
+        'detect_image': detect_image, 'detect_scale': detect_scale,
+        'crop_image': crop_image, 'crop_scale': crop_scale,
+        'original_size': original_size
+    }
+
+def _single_level_frame(image: np.ndarray) -> dict:
+    """Wrap an already decoded BGR array as a one-level frame"""
+    h, w = image.shape[:2]
+    return {
+        'detect_image': image, 'detect_scale': (1.0, 1.0),
+        'crop_image': image, 'crop_scale': (1.0, 1.0),
+        'original_size': (w, h)
+    }
+
+def _unknown_result(error) -> dict:
+    """Classification result used when an image could not be classified"""
+    return {
+        'predicted_class': 'unknown',
+        'confidence': 0.0,
+        'all_probabilities': {},
+        'error': str(error)
+    }
+
+def annotate_frame(image: np.ndarray, frame_boxes: list, bounding_boxes: list) -> np.ndarray:
+    """Copy of a frame with its detections drawn in frame pixels"""
+    annotated_image = image.copy()
+    for j, ((cx1, cy1, cx2, cy2), box) in enumerate(zip(frame_boxes, bounding_boxes)):
+        # Draw bounding box on the annotated image with thicker lines for visibility
+        label = box.get('label') or f'Object {j}'
+        cv2.rectangle(annotated_image, (cx1, cy1), (cx2, cy2), (0, 255, 0), 3)
+        cv2.putText(annotated_image, f'{label} ({box["confidence"]:.2f})', 
+                   (cx1, cy1-10), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+    return annotated_image
+
+def render_annotated_jpeg(image: np.ndarray, frame_boxes: list, bounding_boxes: list, quality: int = 85) -> bytes:
+    """Annotated frame encoded as JPEG bytes"""
+    ok, encoded = cv2.imencode('.jpg', annotate_frame(image, frame_boxes, bounding_boxes),
+                               [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Could not encode annotated image")
+    return encoded.tobytes()
 
 class SegmentationService:
-    def __init__(self):
+    def __init__(self, save_crops: bool = None, detect_size: int = 640, crop_size: int = 1280,
+                 save_annotated: bool = None):
         print("Loading YOLO model...")
         self.model = YOLO(os.path.join(os.path.dirname(__file__), '..', 'yolov8n.pt'))
         print("YOLO model loaded!")
         
-    def segment_image(self, image_path: str, output_dir: str = "cropped_objects") -> dict:
-        """Segment objects from image and return list of cropped image paths with bounding boxes"""
-        os.makedirs(output_dir, exist_ok=True)
+        # Crops are handed to the classifier in memory; writing them out is a debug option
+        if save_crops is None:
+            save_crops = os.getenv('SAVE_CROPS', '0').lower() in ('1', 'true', 'yes')
+        self.save_crops = save_crops
+        
+        # Annotated images are rendered on request; writing one per frame is opt-in
+        if save_annotated is None:
+            save_annotated = os.getenv('SAVE_ANNOTATED', '0').lower() in ('1', 'true', 'yes')
+        self.save_annotated = save_annotated
+        
+        # JPEGs are decoded near YOLO's input size for detection and at a
+        # medium resolution for crops, never at full camera resolution
+        self.detect_size = detect_size
+        self.crop_size = crop_size
+        
+    def decode(self, image) -> dict:
+        """Decode an image path, encoded bytes or BGR array into detection and crop levels"""
+        if isinstance(image, np.ndarray):
+            return _single_level_frame(image)
+        if not isinstance(image, (bytes, bytearray, memoryview)):
+            image_path = image
+            if not os.path.exists(image_path):
+                raise ValueError(f"Could not read image from {image_path}")
+            with open(image_path, 'rb') as f:
+                image = f.read()
+        with timed('decode'):
+            return decode_frame(bytes(image), self.detect_size, self.crop_size)
+        
+    def segment_image(self, image, output_dir: str = "cropped_objects", save_crops: bool = None) -> dict:
+        """Segment objects from an image path, encoded bytes or BGR array and return in-memory crops with bounding boxes"""
+        # Decode at reduced resolution
+        frame = self.decode(image)
+        return self.segment_frames([frame], [output_dir], save_crops)[0]
+        
+    def segment_frames(self, frames: list, output_dirs: list, save_crops: bool = None) -> list:
+        """Run one batched YOLO pass over decoded frames and return a segmentation result per frame"""
+        if save_crops is None:
+            save_crops = self.save_crops
         
-        # Read image
-        image = cv2.imread(image_path)
-        if image is None:
-            raise ValueError(f"Could not read image from {image_path}")
-            
         # Run YOLO detection
-        results = self.model(image)
+        observe_batch('detect', len(frames))
+        with timed('yolo'):
+            results = self.model([frame['detect_image'] for frame in frames])
+        
+        with timed('crop'):
+            return [
+                self._build_result(frame, [result], output_dir, save_crops)
+                for frame, result, output_dir in zip(frames, results, output_dirs)
+            ]
         
+    def warm_up(self):
+        """Run one detection on a blank frame so the first request does not pay for lazy initialisation"""
+        blank = np.zeros((self.detect_size, self.detect_size, 3), dtype=np.uint8)
+        self.segment_frames([_single_level_frame(blank)], ["cropped_objects"], save_crops=False)
+        
+    def _build_result(self, frame: dict, results: list, output_dir: str, save_crops: bool) -> dict:
+        """Map detections back to original coordinates and cut crops from the crop level"""
+        if save_crops or self.save_annotated:
+            os.makedirs(output_dir, exist_ok=True)
+        detect_sx, detect_sy = frame['detect_scale']
+        crop_sx, crop_sy = frame['crop_scale']
+        original_w, original_h = frame['original_size']
+        crop_image = frame['crop_image']
+        
+        crops = []
+        frame_boxes = []
         cropped_paths = []
         bounding_boxes = []
-        annotated_image = image.copy()
         
         for i, result in enumerate(results):
             boxes = result.boxes
             if boxes is not None:
                 for j, box in enumerate(boxes):
-                    # Get bounding box coordinates
-                    x1, y1, x2, y2 = box.xyxy[0].cpu().numpy().astype(int)
+                    # Get bounding box coordinates, mapped back to the original image
+                    bx1, by1, bx2, by2 = box.xyxy[0].cpu().numpy()
+                    x1 = int(min(max(bx1 * detect_sx, 0), original_w))
+                    y1 = int(min(max(by1 * detect_sy, 0), original_h))
+                    x2 = int(min(max(bx2 * detect_sx, 0), original_w))
+                    y2 = int(min(max(by2 * detect_sy, 0), original_h))
                     confidence = box.conf[0].cpu().numpy().item()
                     
-                    # Draw bounding box on the annotated image with thicker lines for visibility
-                    cv2.rectangle(annotated_image, (x1, y1), (x2, y2), (0, 255, 0), 3)
-                    cv2.putText(annotated_image, f'Object {j} ({confidence:.2f})', 
-                               (x1, y1-10), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+                    # Same box in crop-level pixels
+                    cx1, cy1 = int(x1 / crop_sx), int(y1 / crop_sy)
+                    cx2, cy2 = int(x2 / crop_sx), int(y2 / crop_sy)
                     
-                    # Add padding for cropping
+                    # Add padding for cropping (20 original-image pixels)
                     padding = 20
-                    h, w = image.shape[:2]
-                    x1_crop = max(0, x1 - padding)
-                    y1_crop = max(0, y1 - padding)
-                    x2_crop = min(w, x2 + padding)
-                    y2_crop = min(h, y2 + padding)
+                    h, w = crop_image.shape[:2]
+                    x1_crop = max(0, cx1 - int(padding / crop_sx))
+                    y1_crop = max(0, cy1 - int(padding / crop_sy))
+                    x2_crop = min(w, cx2 + int(padding / crop_sx))
+                    y2_crop = min(h, cy2 + int(padding / crop_sy))
                     
-                    # Crop the object
-                    cropped_object = image[y1_crop:y2_crop, x1_crop:x2_crop]
+                    # Crop the object (a view into the crop level, no copy)
+                    cropped_object = crop_image[y1_crop:y2_crop, x1_crop:x2_crop]
+                    crops.append(cropped_object)
+                    frame_boxes.append((cx1, cy1, cx2, cy2))
                     
-                    # Save cropped object
-                    crop_filename = f"crop_{i}_{j}.jpg"
-                    crop_path = os.path.join(output_dir, crop_filename)
-                    cv2.imwrite(crop_path, cropped_object)
-                    cropped_paths.append(crop_path)
+                    # Optionally save cropped object for debugging
+                    crop_path = None
+                    if save_crops:
+                        crop_filename = f"crop_{i}_{j}.jpg"
+                        crop_path = os.path.join(output_dir, crop_filename)
+                        cv2.imwrite(crop_path, cropped_object)
+                        cropped_paths.append(crop_path)
                     
                     # Store bounding box info
                     bounding_boxes.append({
@@ -75,26 +274,65 @@ class SegmentationService:
                         'crop_path': crop_path
                     })
         
-        # Save annotated image with bounding boxes
-        annotated_path = os.path.join(output_dir, "annotated_image.jpg")
-        cv2.imwrite(annotated_path, annotated_image)
+        # Optionally save the annotated image with bounding boxes
+        annotated_path = None
+        if self.save_annotated:
+            annotated_path = os.path.join(output_dir, "annotated_image.jpg")
+            with timed('disk_write'):
+                cv2.imwrite(annotated_path, annotate_frame(crop_image, frame_boxes, bounding_boxes))
+        observe_objects('frame', len(crops))
                     
         return {
+            'crops': crops,
+            'frame': crop_image,
+            'frame_boxes': frame_boxes,
             'cropped_paths': cropped_paths,
             'bounding_boxes': bounding_boxes,
             'annotated_image_path': annotated_path,
-            'total_objects': len(cropped_paths)
+            'image_size': {'width': original_w, 'height': original_h},
+            'total_objects': len(crops)
         }
 
 class CLIPService:
-    def __init__(self):
+    def __init__(self, batch_size: int = None, backend: str = None, quantize: str = None, engine: str = None):
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"Using device: {self.device}")
         
+        # Maximum number of crops sent through encode_image in one forward pass
+        self.batch_size = batch_size or int(os.getenv('CLIP_BATCH_SIZE', 32))
+        
+        # Image encoder backend: "torch" (eager PyTorch) or "onnx" (ONNX Runtime export)
+        self.backend = (backend or os.getenv('CLIP_BACKEND', 'torch')).lower()
+        self.onnx_session = None
+        
+        # Optional quantized inference: "none" or "int8" (dynamic INT8, gated by clip_quantize.py)
+        self.quantize = (quantize or os.getenv('CLIP_QUANTIZE', 'none')).lower()
+        
+        # Classification engine: "crop" (one ViT pass per crop) or "region"
+        # (one pass per frame tile, patch tokens pooled inside each box)
+        self.engine = (engine or os.getenv('CLIP_ENGINE', 'crop')).lower()
+        self.region_tiles = int(os.getenv('CLIP_REGION_TILES', 2))
+        
+        # Reference-gallery kNN: weight of the gallery vote fused with the text score (0 disables it)
+        self.gallery_weight = float(os.getenv('CLIP_GALLERY_WEIGHT', 0))
+        self.gallery_top_k = int(os.getenv('CLIP_GALLERY_TOPK', 5))
+        self.gallery = None
+        self._gallery_state = None
+        # Refreshes rewrite the index files and swap the gallery state; one at a time
+        self._gallery_lock = threading.Lock()
+        
+        # LRU cache of embeddings/predictions keyed by perceptual hash of the crop (0 entries disables it)
+        cache_entries = int(os.getenv('CLIP_CACHE_ENTRIES', 4096))
+        cache_mb = float(os.getenv('CLIP_CACHE_MB', 64))
+        self.embedding_cache = BoundedLRUCache(cache_entries, int(cache_mb * 1024 * 1024)) if cache_entries > 0 else None
+        
         # Paths to trained model and metadata - fix path resolution
         base_dir = os.path.dirname(os.path.dirname(__file__))  # Go up from backend to project root
+        self.gallery_dir = os.path.join(base_dir, 'CLIP', 'tool_images')
+        self.gallery_index_dir = os.path.join(base_dir, 'CLIP', 'gallery_index')
         model_path = os.path.join(base_dir, 'CLIP', 'best_surgical_tool_clip.pth')
         metadata_path = os.path.join(base_dir, 'CLIP', 'surgical_tool_metadata.pkl')
+        self.model_path = None
         
         print(f"Looking for trained model at: {model_path}")
         print(f"Looking for metadata at: {metadata_path}")
@@ -104,6 +342,7 @@ class CLIPService:
             self.model, self.preprocess, self.tokenizer, self.metadata = load_trained_model(
                 model_path, metadata_path, self.device
             )
+            self.model_path = model_path
             self.class_names = self.metadata['class_names']
             print(f"✅ Loaded trained model with {len(self.class_names)} classes: {self.class_names}")
         else:
@@ -122,99 +361,287 @@ class CLIPService:
             ]
             self.model.eval()
         
+        # Class prompts are encoded once and reused for every crop
+        self._text_features = None
+        self._text_features_key = None
+        self.get_text_features()
+        
+        if self.backend == 'onnx':
+            self.onnx_session = self._load_onnx_session()
+            if self.onnx_session is None:
+                print("Falling back to the PyTorch image encoder")
+                self.backend = 'torch'
+        
+        if self.quantize == 'int8' and not self._apply_int8():
+            self.quantize = 'none'
+        
+        # Identifies everything a cached prediction depends on
+        version_source = {
+            'weights': weights_fingerprint(self.model_path) if self.model_path else 'openai',
+            'backend': self.backend,
+            'quantize': self.quantize,
+            'class_names': list(self.class_names)
+        }
+        self.model_version = hashlib.sha1(json.dumps(version_source, sort_keys=True).encode()).hexdigest()[:12]
+        
+        if self.gallery_weight > 0:
+            self.refresh_gallery()
+    
+    def _apply_int8(self) -> bool:
+        """Quantize the image tower if the evaluation report accepted INT8 for these weights"""
+        if self.backend != 'torch' or self.device != 'cpu':
+            print("❌ INT8 quantization is only available for the PyTorch backend on CPU")
+            return False
+        if self.model_path is None:
+            print("❌ INT8 quantization needs the fine-tuned model")
+            return False
+        
+        report_path = quantization_report_path(self.model_path)
+        try:
+            with open(report_path) as f:
+                report = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"❌ No INT8 evaluation report at {report_path} (run CLIP/clip_quantize.py): {e}")
+            return False
+        if report.get('fingerprint') != model_fingerprint(self.model_path, self.class_names):
+            print("❌ INT8 evaluation report is stale, re-run CLIP/clip_quantize.py")
+            return False
+        if not report.get('accepted'):
+            print(f"❌ INT8 model was rejected: accuracy delta {report.get('accuracy_delta', 0):+.2%}")
+            return False
+        
+        quantize_image_tower(self.model)
+        print(f"✅ Using INT8 image tower (accuracy delta {report['accuracy_delta']:+.2%}, {report['speedup']:.2f}x faster)")
+        return True
+    
+    def _load_onnx_session(self):
+        """Open the ONNX Runtime session for the exported image tower, or return None if unusable"""
+        if self.model_path is None:
+            print("❌ ONNX backend needs the fine-tuned model")
+            return None
+        onnx_path = onnx_model_path(self.model_path)
+        if not os.path.exists(onnx_path):
+            print(f"❌ ONNX export not found at {onnx_path} (run CLIP/clip_export_onnx.py)")
+            return None
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            print("❌ onnxruntime is not installed")
+            return None
+        
+        # Refuse exports built from other weights or another class list
+        try:
+            with open(onnx_metadata_path(onnx_path)) as f:
+                export_fingerprint = json.load(f)['fingerprint']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"❌ Could not read ONNX export metadata: {e}")
+            return None
+        if export_fingerprint != model_fingerprint(self.model_path, self.class_names):
+            print("❌ ONNX export is stale, re-run CLIP/clip_export_onnx.py")
+            return None
+        
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = int(os.getenv('ORT_INTRA_OP_THREADS', 0))
+        options.inter_op_num_threads = int(os.getenv('ORT_INTER_OP_THREADS', 0))
+        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if self.device == 'cuda' else ['CPUExecutionProvider']
+        providers = [p for p in providers if p in ort.get_available_providers()]
+        session = ort.InferenceSession(onnx_path, sess_options=options, providers=providers)
+        print(f"✅ Loaded ONNX image encoder from {onnx_path}")
+        return session
+    
+    def refresh_gallery(self) -> dict:
+        """Sync the gallery index with CLIP/tool_images; return how many images were added and removed"""
+        with self._gallery_lock:
+            if not os.path.isdir(self.gallery_dir):
+                print(f"❌ Reference gallery not found at {self.gallery_dir}")
+                return {'added': 0, 'removed': 0}
+            if self.gallery is None:
+                if self.model_path is not None:
+                    fingerprint = weights_fingerprint(self.model_path)
+                else:
+                    fingerprint = {'pretrained': 'openai'}
+                fingerprint['encoder'] = f"{self.backend}-{self.quantize}"
+                self.gallery = GalleryIndex(self.gallery_dir, self.gallery_index_dir, fingerprint)
+            
+            changes = self.gallery.refresh(self._encode_paths)
+            if (changes['added'] or changes['removed']) and self.embedding_cache is not None:
+                # Cached predictions were fused with the old gallery
+                self.embedding_cache.clear()
+            if len(self.gallery) == 0:
+                self._gallery_state = None
+                return changes
+            
+            # Gallery classes without a text prompt (new instruments) extend the output classes
+            output_classes = list(self.class_names) + [
+                name for name in self.gallery.class_names if name not in self.class_names
+            ]
+            label_map = torch.tensor([output_classes.index(name) for name in self.gallery.class_names])
+            features = torch.from_numpy(np.asarray(self.gallery.embeddings, dtype=np.float32)).to(self.device)
+            labels = label_map[torch.from_numpy(self.gallery.labels)].to(self.device)
+            self._gallery_state = (features, labels, output_classes)
+            return changes
+    
+    def _encode_paths(self, image_paths: list) -> np.ndarray:
+        """Normalized image features for a list of image files, as a float32 array"""
+        image_inputs = [self.preprocess(self._load_image(path)) for path in image_paths]
+        return self.encode_images(image_inputs).float().cpu().numpy()
+    
+    def get_text_features(self) -> torch.Tensor:
+        """Return the normalized class-prompt features, rebuilding them only if the class list changed"""
+        key = tuple(self.class_names)
+        if self._text_features is None or self._text_features_key != key:
+            self._text_features = load_text_features(
+                self.model, self.tokenizer, self.class_names, self.device, self.model_path
+            )
+            self._text_features_key = key
+        return self._text_features
+        
+    def encode_images(self, image_inputs: list, batch_size: int = None) -> torch.Tensor:
+        """Encode preprocessed image tensors in chunks and return normalized image features"""
+        batch_size = batch_size or self.batch_size
+        batch = torch.stack(image_inputs)
+        features = []
+        observe_batch('clip_encode', len(image_inputs))
+        with timed('clip_encode'), torch.no_grad():
+            for start in range(0, len(batch), batch_size):
+                chunk = batch[start:start + batch_size]
+                if self.onnx_session is not None:
+                    # The export already returns normalized features
+                    image_features = self.onnx_session.run(['image_features'], {'pixel_values': chunk.numpy()})[0]
+                    features.append(torch.from_numpy(image_features).to(self.device))
+                else:
+                    image_features = self.model.encode_image(chunk.to(self.device))
+                    features.append(image_features / image_features.norm(dim=-1, keepdim=True))
+        return torch.cat(features)
+    
+    def predict_from_features(self, image_features: torch.Tensor) -> list:
+        """Score normalized image features against the class prompts in one vectorized step"""
+        class_names = self.class_names
+        gallery_state = self._gallery_state
+        with timed('clip_predict'), torch.no_grad():
+            similarity = 100.0 * image_features @ self.get_text_features().T
+            probabilities = torch.softmax(similarity, dim=-1)
+            
+            # Fuse with the nearest-neighbour vote over the reference gallery
+            if gallery_state is not None:
+                gallery_features, gallery_labels, class_names = gallery_state
+                gallery_probabilities = gallery_scores(
+                    image_features.float(), gallery_features, gallery_labels, len(class_names), self.gallery_top_k
+                )
+                probabilities = torch.nn.functional.pad(
+                    probabilities.float(), (0, len(class_names) - probabilities.shape[1])
+                )
+                probabilities = (1 - self.gallery_weight) * probabilities + self.gallery_weight * gallery_probabilities
+            
+            confidences, predicted = probabilities.max(dim=-1)
+        
+        # Move everything to the host once instead of calling .item() per value
+        probabilities = probabilities.cpu().tolist()
+        confidences = confidences.cpu().tolist()
+        predicted = predicted.cpu().tolist()
+        
+        return [
+            {
+                'predicted_class': class_names[predicted_idx],
+                'confidence': confidence,
+                'all_probabilities': dict(zip(class_names, row))
+            }
+            for predicted_idx, confidence, row in zip(predicted, confidences, probabilities)
+        ]
+    
+    def classify_batch(self, image_inputs: list, batch_size: int = None) -> list:
+        """Classify a list of preprocessed image tensors and return one result per tensor"""
+        if not image_inputs:
+            return []
+        return self.predict_from_features(self.encode_images(image_inputs, batch_size))
+        
+    def _load_image(self, image) -> Image.Image:
+        """Return an RGB PIL image from a file path or an in-memory BGR crop"""
+        if isinstance(image, np.ndarray):
+            return Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        return Image.open(image).convert('RGB')
+        
     def classify_image(self, image_path: str) -> dict:
         """Classify a single image and return prediction results"""
         try:
-            # Check if we have trained model loaded
-            if hasattr(self, 'metadata'):
-                # Use the trained model with clip_inference function
-                # Need to pass tokenizer as well - create a modified version
-                image = Image.open(image_path).convert('RGB')
-                image_input = self.preprocess(image).unsqueeze(0).to(self.device)
-                
-                with torch.no_grad():
-                    image_features = self.model.encode_image(image_input)
-                    
-                    # Create text features for all classes
-                    class_names = self.metadata['class_names']
-                    text_inputs = [f"a photo of a {class_name}" for class_name in class_names]
-                    text_tokens = self.tokenizer(text_inputs).to(self.device)
-                    text_features = self.model.encode_text(text_tokens)
-                    
-                    # Normalize features
-                    image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-                    text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-                    
-                    # Calculate similarity
-                    similarity = 100.0 * image_features @ text_features.T
-                    
-                    # Get predictions
-                    probabilities = torch.softmax(similarity, dim=-1)
-                    predicted_idx = torch.argmax(similarity, dim=-1).item()
-                    confidence = probabilities[0][predicted_idx].item()
-                    
-                    return {
-                        'predicted_class': class_names[predicted_idx],
-                        'confidence': confidence,
-                        'all_probabilities': {
-                            class_names[i]: probabilities[0][i].item() 
-                            for i in range(len(class_names))
-                        }
-                    }
-            else:
-                # Use fallback classification with open_clip
-                image = Image.open(image_path).convert('RGB')
-                image_input = self.preprocess(image).unsqueeze(0).to(self.device)
-                
-                with torch.no_grad():
-                    image_features = self.model.encode_image(image_input)
-                    
-                    # Create text features for all classes
-                    text_inputs = [f"a photo of a {class_name}" for class_name in self.class_names]
-                    text_tokens = self.tokenizer(text_inputs).to(self.device)
-                    text_features = self.model.encode_text(text_tokens)
-                    
-                    # Normalize features
-                    image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-                    text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-                    
-                    # Calculate similarity
-                    similarity = 100.0 * image_features @ text_features.T
-                    
-                    # Get predictions
-                    probabilities = torch.softmax(similarity, dim=-1)
-                    predicted_idx = torch.argmax(similarity, dim=-1).item()
-                    confidence = probabilities[0][predicted_idx].item()
-                    
-                    return {
-                        'predicted_class': self.class_names[predicted_idx],
-                        'confidence': confidence,
-                        'all_probabilities': {
-                            self.class_names[i]: probabilities[0][i].item() 
-                            for i in range(len(self.class_names))
-                        }
-                    }
+            image = self._load_image(image_path)
+            return self.classify_batch([self.preprocess(image)])[0]
         except Exception as e:
             print(f"Error classifying image {image_path}: {e}")
-            return {
-                'predicted_class': 'unknown',
-                'confidence': 0.0,
-                'all_probabilities': {},
-                'error': str(e)
-            }
+            return _unknown_result(e)
             
-    def classify_multiple_images(self, image_paths: list) -> dict:
-        """Classify multiple images and return aggregated results"""
+    def classify_multiple_images(self, image_paths: list, batch_size: int = None, keys: list = None) -> dict:
+        """Classify multiple images (paths or BGR crops) in batches and return aggregated results"""
+        # In-memory crops have no path, so results are keyed by the caller's ids
+        if keys is None:
+            keys = [image if isinstance(image, str) else f"crop_{i}" for i, image in enumerate(image_paths)]
+        return self._aggregate(keys, self._classify_items(image_paths, keys, batch_size))
+    
+    def _classify_items(self, image_paths: list, keys: list, batch_size: int = None) -> dict:
+        """Classify images in batches and return a result per key"""
         results = {}
-        tool_counts = {}
         
+        # Preprocess every readable image so they can be encoded together,
+        # skipping in-memory crops whose perceptual hash is already cached
+        loaded_keys = []
+        image_inputs = []
+        cache_keys = {}
+        with timed('clip_preprocess'):
+            for key, image in zip(keys, image_paths):
+                try:
+                    if self.embedding_cache is not None and isinstance(image, np.ndarray):
+                        cache_key = (perceptual_hash(image), self.model_version)
+                        cached = self.embedding_cache.get(cache_key)
+                        if cached is not None:
+                            results[key] = cached[1]
+                            continue
+                        cache_keys[key] = cache_key
+                    image_inputs.append(self.preprocess(self._load_image(image)))
+                    loaded_keys.append(key)
+                except Exception as e:
+                    print(f"Error classifying image {key}: {e}")
+                    results[key] = _unknown_result(e)
+        
+        try:
+            if image_inputs:
+                image_features = self.encode_images(image_inputs, batch_size)
+                batch_results = self.predict_from_features(image_features)
+                self._cache_predictions(loaded_keys, cache_keys, image_features, batch_results)
+            else:
+                batch_results = []
+        except Exception as e:
+            print(f"Error classifying batch of {len(image_inputs)} images: {e}")
+            batch_results = [_unknown_result(e) for _ in image_inputs]
+        results.update(zip(loaded_keys, batch_results))
+        return results
+    
+    def _cache_predictions(self, keys: list, cache_keys: dict, image_features: torch.Tensor, predictions: list):
+        """Store embeddings and predictions of freshly encoded crops in the perceptual-hash cache"""
+        if not cache_keys:
+            return
+        features = image_features.half().cpu()
+        for row, (key, prediction) in enumerate(zip(keys, predictions)):
+            cache_key = cache_keys.get(key)
+            if cache_key is None:
+                continue
+            embedding = features[row].clone()
+            # Embedding bytes plus a rough allowance for the prediction dict
+            size = embedding.nelement() * embedding.element_size() + 96 * len(prediction['all_probabilities']) + 256
+            self.embedding_cache.put(cache_key, (embedding, prediction), size)
+    
+    @property
+    def confidence_threshold(self) -> float:
+        """Minimum confidence for a prediction to count as a detected tool"""
         # Use higher confidence threshold for trained model
-        confidence_threshold = 0.3 if hasattr(self, 'metadata') else 0.5
+        return 0.3 if hasattr(self, 'metadata') else 0.5
+    
+    def _aggregate(self, keys: list, results: dict) -> dict:
+        """Count confident predictions per tool, in input order"""
+        tool_counts = {}
+        confidence_threshold = self.confidence_threshold
         
-        for image_path in image_paths:
-            result = self.classify_image(image_path)
-            results[image_path] = result
-            
+        results = {key: results[key] for key in keys}
+        for image_path, result in results.items():
             if 'predicted_class' in result and result['confidence'] > confidence_threshold:
                 tool_name = result['predicted_class']
                 tool_counts[tool_name] = tool_counts.get(tool_name, 0) + 1
@@ -223,57 +650,120 @@ class CLIPService:
         return {
             'individual_results': results,
             'tool_counts': tool_counts,
-            'total_objects': len(image_paths)
+            'total_objects': len(keys)
         }
-
-class MCPService:
-    def __init__(self):
-        try:
-            from tool_requirement_agent import ToolRequirementAgent
-            self.agent = ToolRequirementAgent()
-        except ImportError:
-            print("MCP scraping agent not available, using fallback")
-            self.agent = None
-            
-    def get_procedure_tools(self, procedure: str) -> list:
-        """Get required tools for a medical procedure"""
-        if self.agent:
+    
+    def encode_regions(self, frame: np.ndarray, boxes: list) -> torch.Tensor:
+        """Encode a BGR frame once as a grid of model-sized tiles and pool patch tokens inside each box"""
+        visual = self.model.visual
+        tile_h, tile_w = visual.image_size if isinstance(visual.image_size, tuple) else (visual.image_size,) * 2
+        patch_h, patch_w = visual.patch_size if isinstance(visual.patch_size, tuple) else (visual.patch_size,) * 2
+        grid_h, grid_w = tile_h // patch_h, tile_w // patch_w
+        
+        # Split the long side into region_tiles tiles and keep the aspect ratio on the short side
+        h, w = frame.shape[:2]
+        if w >= h:
+            cols = self.region_tiles
+            rows = max(1, round(cols * h / w))
+        else:
+            rows = self.region_tiles
+            cols = max(1, round(rows * w / h))
+        
+        resized = cv2.resize(frame, (cols * tile_w, rows * tile_h), interpolation=cv2.INTER_AREA)
+        pixels = torch.from_numpy(cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)).to(self.device).float().div_(255)
+        mean = torch.tensor(getattr(visual, 'image_mean', None) or open_clip.OPENAI_DATASET_MEAN, device=self.device)
+        std = torch.tensor(getattr(visual, 'image_std', None) or open_clip.OPENAI_DATASET_STD, device=self.device)
+        pixels = ((pixels - mean) / std).permute(2, 0, 1)
+        
+        # (3, rows*H, cols*W) -> (rows*cols, 3, H, W)
+        tiles = pixels.unfold(1, tile_h, tile_h).unfold(2, tile_w, tile_w)
+        tiles = tiles.permute(1, 2, 0, 3, 4).reshape(rows * cols, 3, tile_h, tile_w)
+        
+        with torch.no_grad():
+            # Capture the post-ln_post token sequence instead of toggling the shared
+            # output_tokens flag; the hook ignores calls from other threads
+            captured = {}
+            thread_id = threading.get_ident()
+            def capture(module, inputs, output):
+                if threading.get_ident() == thread_id:
+                    captured['tokens'] = output
+            handle = visual.ln_post.register_forward_hook(capture)
             try:
-                result = self.agent.get_procedure_tools(procedure)
-                if 'tools_needed' in result:
-                    return result['tools_needed']
-                elif 'crash_cart_tools' in result:
-                    return result['crash_cart_tools']
-            except Exception as e:
-                print(f"Error getting tools from MCP agent: {e}")
-                
-        # Fallback tool lists for common procedures
-        fallback_tools = {
-            "code blue": [
-                "defibrillator", "oxygen mask", "ambu bag", "iv catheter", 
-                "syringe", "epinephrine", "atropine", "cardiac monitor"
-            ],
-            "intubation": [
-                "laryngoscope", "endotracheal tube", "ambu bag", "oxygen mask",
-                "suction catheter", "stylet", "syringe"
-            ],
-            "cardiac arrest": [
-                "defibrillator", "oxygen mask", "ambu bag", "iv catheter",
-                "syringe", "epinephrine", "atropine", "cardiac monitor"
-            ],
-            "trauma": [
-                "gauze", "bandage", "iv catheter", "syringe", "saline",
-                "blood pressure cuff", "stethoscope", "splint"
-            ]
-        }
+                visual(tiles)
+            finally:
+                handle.remove()
+            tokens = captured.get('tokens')
+            if tokens is None or tokens.dim() != 3:
+                raise RuntimeError("Region engine needs a ViT whose ln_post sees the full token sequence")
+            # Patch tokens follow the class token (and any prefix tokens)
+            tokens = tokens[:, -grid_h * grid_w:]
+            if visual.proj is not None:
+                tokens = tokens @ visual.proj
+            
+            # Stitch the tiles back into one (rows*grid_h, cols*grid_w, dim) token map
+            dim = tokens.shape[-1]
+            token_map = tokens.reshape(rows, cols, grid_h, grid_w, dim)
+            token_map = token_map.permute(0, 2, 1, 3, 4).reshape(rows * grid_h, cols * grid_w, dim)
+            
+            # Summed-area table so every box is pooled with four lookups
+            integral = torch.nn.functional.pad(token_map.cumsum(0).cumsum(1), (0, 0, 1, 0, 1, 0))
+            
+            # Box corners in token-grid cells, each box covering at least one cell
+            map_h, map_w = token_map.shape[:2]
+            box_tensor = torch.tensor(boxes, dtype=torch.float32, device=self.device).reshape(-1, 4)
+            gx1 = (box_tensor[:, 0] * map_w / w).floor().long().clamp(0, map_w - 1)
+            gy1 = (box_tensor[:, 1] * map_h / h).floor().long().clamp(0, map_h - 1)
+            gx2 = torch.maximum((box_tensor[:, 2] * map_w / w).ceil().long().clamp(max=map_w), gx1 + 1)
+            gy2 = torch.maximum((box_tensor[:, 3] * map_h / h).ceil().long().clamp(max=map_h), gy1 + 1)
+            
+            sums = integral[gy2, gx2] - integral[gy1, gx2] - integral[gy2, gx1] + integral[gy1, gx1]
+            area = ((gy2 - gy1) * (gx2 - gx1)).unsqueeze(-1).float()
+            region_features = sums / area
+            return region_features / region_features.norm(dim=-1, keepdim=True)
+    
+    def classify_regions(self, frame: np.ndarray, boxes: list, keys: list) -> dict:
+        """Classify every box from a single encoding of the frame and return aggregated results"""
+        if not boxes:
+            return self._aggregate([], {})
+        try:
+            with timed('clip_regions'):
+                region_features = self.encode_regions(frame, boxes)
+            batch_results = self.predict_from_features(region_features)
+        except Exception as e:
+            print(f"Error classifying {len(boxes)} regions: {e}")
+            batch_results = [_unknown_result(e) for _ in boxes]
+        return self._aggregate(keys, dict(zip(keys, batch_results)))
+    
+    def classify_segmentation(self, segmentation_result: dict) -> dict:
+        """Classify the objects of a SegmentationService result with the configured engine"""
+        keys = [box['object_id'] for box in segmentation_result['bounding_boxes']]
+        if self.engine == 'region':
+            return self.classify_regions(segmentation_result['frame'], segmentation_result['frame_boxes'], keys)
+        return self.classify_multiple_images(segmentation_result['crops'], keys=keys)
+    
+    def classify_segmentations(self, segmentation_results: list) -> list:
+        """Classify the objects of several frames together, returning one aggregated result per frame"""
+        if self.engine == 'region':
+            return [self.classify_segmentation(result) for result in segmentation_results]
         
-        procedure_lower = procedure.lower()
-        for key, tools in fallback_tools.items():
-            if key in procedure_lower:
-                return tools
-                
-        # Default emergency tools
-        return [
-            "stethoscope", "blood pressure cuff", "syringe", "iv catheter",
-            "gauze", "bandage", "oxygen mask", "defibrillator"
-        ]
+        # Crops from every frame share one batched encode
+        images = []
+        item_keys = []
+        for n, result in enumerate(segmentation_results):
+            for box, crop in zip(result['bounding_boxes'], result['crops']):
+                images.append(crop)
+                item_keys.append((n, box['object_id']))
+        combined = self._classify_items(images, item_keys)
+        
+        classified = []
+        for n, result in enumerate(segmentation_results):
+            keys = [box['object_id'] for box in result['bounding_boxes']]
+            classified.append(self._aggregate(keys, {key: combined[(n, key)] for key in keys}))
+        return classified
+    
+    def warm_up(self):
+        """Classify a blank crop (and encode a blank frame for the region engine) to initialise kernels and text features"""
+        blank = np.zeros((224, 224, 3), dtype=np.uint8)
+        self.classify_batch([self.preprocess(self._load_image(blank))])
+        if self.engine == 'region':
+            self.encode_regions(blank, [(0, 0, 224, 224)])
@@ -0,0 +1,366 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Heavy per-image payloads kept apart from the session body and only loaded on request
+BLOB_FIELDS = ('processed_images',)
+
+def _split_fields(fields: dict):
+    body = {k: v for k, v in fields.items() if k not in BLOB_FIELDS}
+    blobs = {k: v for k, v in fields.items() if k in BLOB_FIELDS}
+    return body, blobs
+
+def _log_matches(entry: dict, procedure: str = None, missing_tool: str = None) -> bool:
+    if procedure is not None and (entry.get('procedure') or '').lower() != procedure.lower():
+        return False
+    if missing_tool is not None and missing_tool.lower() not in [t.lower() for t in entry.get('missing_tools', [])]:
+        return False
+    return True
+
+class SessionObjects:
+    """Live per-process objects keyed by session id (trackers, gates, ...), bounded like the sessions.
+
+    Entries are dropped past max_sessions (least recently used first) or when
+    not touched for ttl_seconds, so they do not outlive the sessions they serve.
+    """
+    def __init__(self, max_sessions: int = 1000, ttl_seconds: float = 24 * 3600):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict()  # session_id -> (object, last access)
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _evict(self, now: float):
+        if self.ttl_seconds > 0:
+            # Oldest access first, so expired entries sit at the front
+            while self._data and now - next(iter(self._data.values()))[1] > self.ttl_seconds:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        while len(self._data) > self.max_sessions:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, session_id: str, default=None):
+        with self._lock:
+            now = time.time()
+            self._evict(now)
+            entry = self._data.get(session_id)
+            if entry is None:
+                return default
+            self._data[session_id] = (entry[0], now)
+            self._data.move_to_end(session_id)
+            return entry[0]
+
+    def setdefault(self, session_id: str, default):
+        """Object stored for the session, storing default first if there is none"""
+        with self._lock:
+            now = time.time()
+            entry = self._data.get(session_id)
+            value = default if entry is None else entry[0]
+            self._data[session_id] = (value, now)
+            self._data.move_to_end(session_id)
+            self._evict(now)
+            return value
+
+    def values(self) -> list:
+        with self._lock:
+            return [value for value, _ in self._data.values()]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+class MemorySessionStore:
+    """Per-process session store with LRU eviction and an idle TTL"""
+    def __init__(self, max_sessions: int = 1000, ttl_seconds: float = 24 * 3600, max_logs: int = 10000):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict()  # session_id -> (body, blobs, last update)
+        self._lock = threading.Lock()
+        self.evictions = 0
+        # Validation log ring buffer of (log_id, entry), oldest first
+        self._logs = deque(maxlen=max_logs)
+        self._next_log_id = 1
+
+    def _expired(self, entry) -> bool:
+        return self.ttl_seconds > 0 and time.time() - entry[2] > self.ttl_seconds
+
+    def _get_entry(self, session_id: str):
+        entry = self._data.get(session_id)
+        if entry is None:
+            return None
+        if self._expired(entry):
+            del self._data[session_id]
+            self.evictions += 1
+            return None
+        self._data.move_to_end(session_id)
+        return entry
+
+    def __contains__(self, session_id: str):
+        with self._lock:
+            return self._get_entry(session_id) is not None
+
+    def create(self, session_id: str, session: dict):
+        body, blobs = _split_fields(session)
+        with self._lock:
+            self._data[session_id] = (body, blobs, time.time())
+            self._data.move_to_end(session_id)
+            # Drop expired sessions first, then the least recently used ones past the cap
+            for key in [key for key, entry in self._data.items() if self._expired(entry)]:
+                del self._data[key]
+                self.evictions += 1
+            while len(self._data) > self.max_sessions:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, session_id: str, include_blobs: bool = False):
+        """Session body (plus blobs on request), or None if unknown or expired"""
+        with self._lock:
+            entry = self._get_entry(session_id)
+            if entry is None:
+                return None
+            session = dict(entry[0])
+            if include_blobs:
+                session.update(entry[1])
+            return session
+
+    def update(self, session_id: str, **fields):
+        body, blobs = _split_fields(fields)
+        with self._lock:
+            entry = self._get_entry(session_id)
+            if entry is None:
+                raise KeyError(session_id)
+            self._data[session_id] = ({**entry[0], **body}, {**entry[1], **blobs}, time.time())
+
+    def append_log(self, entry: dict) -> int:
+        """Record a validation log entry and return its id"""
+        with self._lock:
+            log_id = self._next_log_id
+            self._next_log_id += 1
+            self._logs.append((log_id, entry))
+            return log_id
+
+    def logs(self, limit: int = 50, cursor: int = None, procedure: str = None, missing_tool: str = None):
+        """Newest-first log entries older than cursor; returns (entries, next cursor or None)"""
+        with self._lock:
+            snapshot = list(self._logs)
+        entries = []
+        for log_id, entry in reversed(snapshot):
+            if cursor is not None and log_id >= cursor:
+                continue
+            if _log_matches(entry, procedure, missing_tool):
+                entries.append({'log_id': log_id, **entry})
+                if len(entries) == limit:
+                    break
+        next_cursor = entries[-1]['log_id'] if len(entries) == limit else None
+        return entries, next_cursor
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'sessions': len(self._data),
+                'evictions': self.evictions,
+                'validation_logs': len(self._logs)
+            }
+
+class SQLiteSessionStore:
+    """Session store in an embedded SQLite database (WAL), shared by all workers on one host"""
+    def __init__(self, db_path: str = "sessions.db", ttl_seconds: float = 24 * 3600, max_logs: int = 10000):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_logs = max_logs
+        self._local = threading.local()
+        self._last_purge = 0.0
+        with self._connection() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    procedure TEXT,
+                    timestamp TEXT NOT NULL,
+                    validation_complete INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL,
+                    body TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_sessions_timestamp ON sessions (timestamp);
+                CREATE INDEX IF NOT EXISTS idx_sessions_complete ON sessions (validation_complete, timestamp);
+                CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at);
+                CREATE TABLE IF NOT EXISTS session_blobs (
+                    session_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (session_id, name)
+                );
+                CREATE TABLE IF NOT EXISTS validation_logs (
+                    log_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    procedure_key TEXT,
+                    entry TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_logs_procedure ON validation_logs (procedure_key, log_id);
+                CREATE TABLE IF NOT EXISTS validation_log_missing (
+                    tool_key TEXT NOT NULL,
+                    log_id INTEGER NOT NULL,
+                    PRIMARY KEY (tool_key, log_id)
+                );
+            """)
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread; sqlite3 connections must not be shared across threads"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, conn, session_id: str, body: dict, blobs: dict):
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, procedure, timestamp, validation_complete, updated_at, body) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (session_id, body.get('procedure'), body.get('timestamp', ''),
+             int(bool(body.get('validation_complete'))), time.time(), json.dumps(body))
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO session_blobs (session_id, name, data) VALUES (?, ?, ?)",
+            [(session_id, name, json.dumps(value)) for name, value in blobs.items()]
+        )
+
+    def _purge(self, conn):
+        """Delete sessions not updated within the TTL, at most once a minute"""
+        now = time.time()
+        if self.ttl_seconds <= 0 or now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        cutoff = now - self.ttl_seconds
+        conn.execute(
+            "DELETE FROM session_blobs WHERE session_id IN (SELECT session_id FROM sessions WHERE updated_at < ?)",
+            (cutoff,)
+        )
+        conn.execute("DELETE FROM sessions WHERE updated_at < ?", (cutoff,))
+        # Keep only the newest max_logs validation log entries
+        (last_id,) = conn.execute("SELECT COALESCE(MAX(log_id), 0) FROM validation_logs").fetchone()
+        conn.execute("DELETE FROM validation_logs WHERE log_id <= ?", (last_id - self.max_logs,))
+        conn.execute("DELETE FROM validation_log_missing WHERE log_id <= ?", (last_id - self.max_logs,))
+
+    def _load_body(self, conn, session_id: str):
+        row = conn.execute(
+            "SELECT body, updated_at FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        if self.ttl_seconds > 0 and time.time() - row[1] > self.ttl_seconds:
+            return None
+        return json.loads(row[0])
+
+    def __contains__(self, session_id: str):
+        row = self._connection().execute(
+            "SELECT updated_at FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row is not None and (self.ttl_seconds <= 0 or time.time() - row[0] <= self.ttl_seconds)
+
+    def create(self, session_id: str, session: dict):
+        body, blobs = _split_fields(session)
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._purge(conn)
+            self._write(conn, session_id, body, blobs)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get(self, session_id: str, include_blobs: bool = False):
+        """Session body (plus blobs on request), or None if unknown or expired"""
+        conn = self._connection()
+        session = self._load_body(conn, session_id)
+        if session is None or not include_blobs:
+            return session
+        for name, data in conn.execute(
+            "SELECT name, data FROM session_blobs WHERE session_id = ?", (session_id,)
+        ):
+            session[name] = json.loads(data)
+        return session
+
+    def update(self, session_id: str, **fields):
+        body, blobs = _split_fields(fields)
+        conn = self._connection()
+        # IMMEDIATE takes the write lock up front so concurrent read-modify-writes cannot interleave
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            session = self._load_body(conn, session_id)
+            if session is None:
+                raise KeyError(session_id)
+            session.update(body)
+            self._write(conn, session_id, session, blobs)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def append_log(self, entry: dict) -> int:
+        """Record a validation log entry and return its id"""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            log_id = conn.execute(
+                "INSERT INTO validation_logs (procedure_key, entry) VALUES (?, ?)",
+                ((entry.get('procedure') or '').lower(), json.dumps(entry))
+            ).lastrowid
+            conn.executemany(
+                "INSERT OR IGNORE INTO validation_log_missing (tool_key, log_id) VALUES (?, ?)",
+                [(tool.lower(), log_id) for tool in entry.get('missing_tools', [])]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return log_id
+
+    def logs(self, limit: int = 50, cursor: int = None, procedure: str = None, missing_tool: str = None):
+        """Newest-first log entries older than cursor; returns (entries, next cursor or None)"""
+        query = "SELECT log_id, entry FROM validation_logs WHERE log_id < ?"
+        params = [cursor if cursor is not None else 2 ** 63 - 1]
+        if procedure is not None:
+            query += " AND procedure_key = ?"
+            params.append(procedure.lower())
+        if missing_tool is not None:
+            query += " AND log_id IN (SELECT log_id FROM validation_log_missing WHERE tool_key = ?)"
+            params.append(missing_tool.lower())
+        query += " ORDER BY log_id DESC LIMIT ?"
+        params.append(limit)
+        rows = self._connection().execute(query, params).fetchall()
+        entries = [{'log_id': log_id, **json.loads(entry)} for log_id, entry in rows]
+        next_cursor = entries[-1]['log_id'] if len(entries) == limit else None
+        return entries, next_cursor
+
+    def stats(self) -> dict:
+        conn = self._connection()
+        (count,) = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()
+        (logs,) = conn.execute("SELECT COUNT(*) FROM validation_logs").fetchone()
+        return {'backend': 'sqlite', 'db_path': self.db_path, 'sessions': count, 'validation_logs': logs}
+
+def open_session_objects(ttl_seconds: float = None) -> SessionObjects:
+    """Bounded holder for live per-session objects, sized by SESSION_MAX and SESSION_TTL_HOURS"""
+    if ttl_seconds is None:
+        ttl_seconds = 3600 * float(os.getenv('SESSION_TTL_HOURS', 24))
+    return SessionObjects(int(os.getenv('SESSION_MAX', 1000)), ttl_seconds)
+
+def open_session_store(backend: str = None, db_path: str = None, max_sessions: int = None,
+                       ttl_hours: float = None, max_logs: int = None):
+    """Session store selected by SESSION_STORE (memory|sqlite)"""
+    backend = (backend or os.getenv('SESSION_STORE', 'memory')).lower()
+    ttl_seconds = 3600 * float(ttl_hours if ttl_hours is not None else os.getenv('SESSION_TTL_HOURS', 24))
+    max_logs = int(max_logs or os.getenv('VALIDATION_LOG_MAX', 10000))
+    if backend == 'sqlite':
+        store = SQLiteSessionStore(db_path or os.getenv('SESSION_DB_PATH', 'sessions.db'), ttl_seconds, max_logs)
+    elif backend == 'memory':
+        store = MemorySessionStore(int(max_sessions or os.getenv('SESSION_MAX', 1000)), ttl_seconds, max_logs)
+    else:
+        raise ValueError(f"Unknown SESSION_STORE '{backend}', expected 'memory' or 'sqlite'")
+    print(f"✅ Session store: {backend}")
+    return store
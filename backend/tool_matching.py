@@ -0,0 +1,104 @@
+import json
+import os
+from functools import lru_cache
+
+def normalize_tool_name(name: str) -> str:
+    return name.lower().replace("_", " ").strip()
+
+def load_aliases(path: str = None) -> dict:
+    """Alias lists per required tool name from TOOL_ALIASES_PATH (JSON {tool: [alias, ...]})"""
+    path = path or os.getenv('TOOL_ALIASES_PATH')
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        aliases = json.load(f)
+    print(f"✅ Loaded tool aliases for {len(aliases)} tools from {path}")
+    return {normalize_tool_name(tool): [normalize_tool_name(a) for a in names] for tool, names in aliases.items()}
+
+TOOL_ALIASES = load_aliases()
+
+class ToolMatcher:
+    """Required-tool list compiled once so each validation costs about O(detected tools).
+
+    Matching follows the original validate_inventory rules: an exact normalized
+    name wins, otherwise the first detected name (in detection order) that
+    contains or is contained in the required name. Detected names related to no
+    required tool in either direction are reported as extra.
+    """
+    def __init__(self, required_tools: list, aliases: dict = None):
+        aliases = TOOL_ALIASES if aliases is None else aliases
+        self.required = {normalize_tool_name(tool): tool for tool in required_tools}
+        # Exact names (and aliases) -> required keys
+        self.exact = {}
+        for norm_req in self.required:
+            for name in [norm_req] + aliases.get(norm_req, []):
+                self.exact.setdefault(name, []).append(norm_req)
+        # Every substring of a required name -> required keys containing it (detected name inside required)
+        self.containing = {}
+        for norm_req in self.required:
+            for start in range(len(norm_req) + 1):
+                for end in range(start, len(norm_req) + 1):
+                    keys = self.containing.setdefault(norm_req[start:end], [])
+                    if not keys or keys[-1] != norm_req:
+                        keys.append(norm_req)
+        # Required name lengths, to find required names inside a detected name with one pass per length
+        self.lengths = sorted({len(norm_req) for norm_req in self.required})
+        # Lowercased names for the realtime exact-match check
+        self.required_lower = [(tool, tool.lower()) for tool in required_tools]
+
+    def related(self, norm_det: str) -> list:
+        """Required keys that contain norm_det or are contained in it"""
+        related = list(self.containing.get(norm_det, ()))
+        for length in self.lengths:
+            if length > len(norm_det):
+                break
+            for start in range(len(norm_det) - length + 1):
+                part = norm_det[start:start + length]
+                if part in self.required and part not in related:
+                    related.append(part)
+        return related
+
+    def match(self, detected_tools: dict) -> tuple:
+        """Return (matched, missing, extra) for detected {tool: count}"""
+        detected = {}
+        for tool, count in detected_tools.items():
+            norm_det = normalize_tool_name(tool)
+            detected[norm_det] = detected.get(norm_det, 0) + count
+
+        exact_match = {}
+        partial_match = {}
+        extra = {}
+        for norm_det, count in detected.items():
+            for norm_req in self.exact.get(norm_det, ()):
+                exact_match.setdefault(norm_req, count)
+            related = self.related(norm_det)
+            for norm_req in related:
+                partial_match.setdefault(norm_req, count)
+            if norm_det not in self.exact and not related:
+                extra[norm_det] = count
+
+        matched = {}
+        missing = []
+        for norm_req, orig_req in self.required.items():
+            if norm_req in detected:
+                matched[orig_req] = detected[norm_req]
+            elif norm_req in exact_match:
+                matched[orig_req] = exact_match[norm_req]
+            elif norm_req in partial_match:
+                matched[orig_req] = partial_match[norm_req]
+            else:
+                missing.append(orig_req)
+        return matched, missing, extra
+
+    def missing_exact(self, detected_tools: dict) -> list:
+        """Required tools with no case-insensitive exact detection (realtime check)"""
+        detected = {tool.lower() for tool in detected_tools}
+        return [tool for tool, lowered in self.required_lower if lowered not in detected]
+
+@lru_cache(maxsize=256)
+def _compiled(required_tools: tuple) -> ToolMatcher:
+    return ToolMatcher(list(required_tools))
+
+def get_matcher(required_tools: list) -> ToolMatcher:
+    """Compiled matcher for a required-tool list, shared by sessions with the same list"""
+    return _compiled(tuple(required_tools))
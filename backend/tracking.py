@@ -0,0 +1,150 @@
+import itertools
+import threading
+
+import numpy as np
+
+class Track:
+    """One physical object followed across frames, with a vote over its CLIP labels"""
+    __slots__ = ('track_id', 'box', 'appearance', 'votes', 'hits', 'missed', 'classifications')
+
+    def __init__(self, track_id: int, box: np.ndarray, appearance: int):
+        self.track_id = track_id
+        self.box = box
+        self.appearance = appearance
+        self.votes = {}
+        self.hits = 1
+        self.missed = 0
+        self.classifications = 0
+
+    def record(self, prediction: dict, confidence_threshold: float):
+        """Add a CLIP prediction; only confident ones count towards the label vote"""
+        self.classifications += 1
+        if prediction.get('confidence', 0.0) > confidence_threshold:
+            label = prediction['predicted_class']
+            self.votes[label] = self.votes.get(label, 0.0) + prediction['confidence']
+
+    @property
+    def label(self):
+        """Label with the highest accumulated confidence, or None before any confident prediction"""
+        if not self.votes:
+            return None
+        return max(self.votes.items(), key=lambda item: item[1])[0]
+
+def iou_matrix(boxes: np.ndarray, others: np.ndarray) -> np.ndarray:
+    """Pairwise IoU between (N, 4) and (M, 4) xyxy boxes"""
+    x1 = np.maximum(boxes[:, None, 0], others[None, :, 0])
+    y1 = np.maximum(boxes[:, None, 1], others[None, :, 1])
+    x2 = np.minimum(boxes[:, None, 2], others[None, :, 2])
+    y2 = np.minimum(boxes[:, None, 3], others[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    other_area = (others[:, 2] - others[:, 0]) * (others[:, 3] - others[:, 1])
+    union = area[:, None] + other_area[None, :] - intersection
+    return intersection / np.maximum(union, 1e-6)
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+class IoUTracker:
+    """Greedy IoU tracker with a centroid fallback that gives YOLO boxes stable ids within one session"""
+    def __init__(self, iou_threshold: float = 0.3, centroid_threshold: float = 0.5,
+                 max_missed: int = 5, appearance_threshold: int = 12, retry_unlabeled: int = 5):
+        self.iou_threshold = iou_threshold
+        # Max centroid shift, as a fraction of the track's box diagonal, for the fallback match
+        self.centroid_threshold = centroid_threshold
+        self.max_missed = max_missed
+        # Perceptual-hash bits that may flip before a track is classified again
+        self.appearance_threshold = appearance_threshold
+        # Tracks without a confident label are re-classified every retry_unlabeled frames
+        self.retry_unlabeled = retry_unlabeled
+        self.tracks = []
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def _match(self, boxes: np.ndarray) -> dict:
+        """Return {box index: track index} using greedy IoU, then centroid distance for leftovers"""
+        if not self.tracks or len(boxes) == 0:
+            return {}
+        track_boxes = np.stack([track.box for track in self.tracks])
+        matches = {}
+        used_tracks = set()
+
+        ious = iou_matrix(boxes, track_boxes)
+        for flat in np.argsort(-ious, axis=None):
+            box_idx, track_idx = np.unravel_index(flat, ious.shape)
+            if ious[box_idx, track_idx] < self.iou_threshold:
+                break
+            if box_idx in matches or track_idx in used_tracks:
+                continue
+            matches[int(box_idx)] = int(track_idx)
+            used_tracks.add(int(track_idx))
+
+        # Fast-moving or re-framed objects may not overlap enough; fall back to centroids
+        free_boxes = [i for i in range(len(boxes)) if i not in matches]
+        free_tracks = [j for j in range(len(self.tracks)) if j not in used_tracks]
+        if free_boxes and free_tracks:
+            centers = (boxes[free_boxes, :2] + boxes[free_boxes, 2:]) / 2
+            track_centers = (track_boxes[free_tracks, :2] + track_boxes[free_tracks, 2:]) / 2
+            diagonals = np.hypot(
+                track_boxes[free_tracks, 2] - track_boxes[free_tracks, 0],
+                track_boxes[free_tracks, 3] - track_boxes[free_tracks, 1]
+            )
+            distances = np.linalg.norm(centers[:, None, :] - track_centers[None, :, :], axis=-1)
+            relative = distances / np.maximum(diagonals[None, :], 1e-6)
+            for flat in np.argsort(relative, axis=None):
+                i, j = np.unravel_index(flat, relative.shape)
+                if relative[i, j] > self.centroid_threshold:
+                    break
+                box_idx, track_idx = free_boxes[i], free_tracks[j]
+                if box_idx in matches or track_idx in used_tracks:
+                    continue
+                matches[box_idx] = track_idx
+                used_tracks.add(track_idx)
+        return matches
+
+    def update(self, boxes: list, appearances: list):
+        """Assign a track to every (x1, y1, x2, y2) box.
+
+        Returns (tracks, needs_classification): the track for each box, and the
+        indices of boxes that are new or whose appearance changed.
+        """
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        matches = self._match(boxes)
+
+        assigned = []
+        needs_classification = []
+        matched_tracks = set()
+        for box_idx, (box, appearance) in enumerate(zip(boxes, appearances)):
+            track_idx = matches.get(box_idx)
+            if track_idx is None:
+                track = Track(next(self._ids), box, appearance)
+                self.tracks.append(track)
+                needs_classification.append(box_idx)
+            else:
+                track = self.tracks[track_idx]
+                track.box = box
+                track.hits += 1
+                track.missed = 0
+                if hamming(track.appearance, appearance) > self.appearance_threshold:
+                    track.appearance = appearance
+                    needs_classification.append(box_idx)
+                elif track.label is None and track.hits % self.retry_unlabeled == 0:
+                    needs_classification.append(box_idx)
+            matched_tracks.add(track.track_id)
+            assigned.append(track)
+
+        # Age out tracks that were not seen in this frame
+        for track in self.tracks:
+            if track.track_id not in matched_tracks:
+                track.missed += 1
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+        return assigned, needs_classification
+
+    def visible_tool_counts(self) -> dict:
+        """Voted labels of the tracks seen in the latest frame"""
+        counts = {}
+        for track in self.tracks:
+            label = track.label
+            if track.missed == 0 and label is not None:
+                counts[label] = counts.get(label, 0) + 1
+        return counts